@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import json
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from os.path import abspath, basename, dirname
+from statistics import median
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path.insert(1, dirname(dirname(abspath(__file__))))  # the repository root, so that it runs from a source checkout
+
+from corpus import generate, get_params
+from tiffexplore import tiffread
+
+try:
+    from tiffexplore.gui import Bar
+except ImportError:  # no PyQt5
+    Bar = None
+
+
+def bench_init(file):
+    tiffread.tiff(file).close()
+
+
+def bench_read_ifd(tiff):
+    store = tiffread.ifdchain()
+    store.offsets.update(tiff.offsets)
+    for idx in tiff.nTags:
+        tiff.read_ifd(idx, store)
+
+
+def bench_get_assignments(tiff):
+    for _ in tiff.addresses.get_assignments():
+        pass
+
+
+def bench_get_empty(tiff):
+    tiff.get_empty()
+
+
+def bench_get_bar(tiff):
+    Bar.get_bar(SimpleNamespace(tiff=tiff, empty_bar=Bar.empty_bar))
+
+
+benchmarks = {'init': bench_init, 'read_ifd': bench_read_ifd, 'get_assignments': bench_get_assignments,
+              'get_empty': bench_get_empty, 'get_bar': bench_get_bar}
+
+
+def measure(fun, arg, repeat=5):
+    """ Min and median time of repeat calls and the peak of memory traced during one more call """
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fun(arg)
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fun(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'min': min(times), 'median': median(times), 'peak_memory': peak}
+
+
+def run(files, names=None, repeat=5):
+    """ Yields a json serializable record for each benchmark on each file """
+    names = names or [name for name in benchmarks if name != 'get_bar' or Bar is not None]
+    for file in files:
+        params = get_params(basename(file))
+        with tiffread.tiff(file, stats=True) as tiff:
+            stats = tiff.stats.asdict()
+            for name in names:
+                record = {'benchmark': name, 'file': basename(file), **params, 'repeat': repeat}
+                record.update(measure(benchmarks[name], file if name == 'init' else tiff, repeat))
+                if name == 'init':
+                    record['stats'] = stats
+                yield record
+
+
+def load(file):
+    with open(file) as f:
+        return {(record['benchmark'], record['file']): record for record in map(json.loads, f)}
+
+
+def compare(old, new, threshold=1.2):
+    """ Prints the ratios new / old of the min time and peak memory of each benchmark, returns whether any
+        ratio is above threshold
+    """
+    old, new = load(old), load(new)
+    regression = False
+    for key in sorted(old.keys() & new.keys()):
+        time = new[key]['min'] / old[key]['min'] if old[key]['min'] else float('inf')
+        memory = new[key]['peak_memory'] / old[key]['peak_memory'] if old[key]['peak_memory'] else float('inf')
+        flag = time > threshold or memory > threshold
+        regression |= flag
+        print(f'{key[0]:16} {key[1]:36} time: {time:6.2f} memory: {memory:6.2f}{"  <--" if flag else ""}')
+    return regression
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark tiffexplore on a synthetic corpus, writes one json record per '
+                                        'benchmark per file to stdout, or compare two such outputs.')
+    parser.add_argument('path', nargs='?', default='corpus', help='directory of the corpus, generated if needed')
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=list(benchmarks), help='benchmarks to run')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed repeats')
+    parser.add_argument('--pages', type=int, nargs='+', default=None, help='only files with these numbers of pages')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two outputs of this script')
+    parser.add_argument('--threshold', type=float, default=1.2, help='ratio above which --compare reports a '
+                                                                      'regression and exits with 1')
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold))
+    files = generate(args.path, args.pages) if args.pages else generate(args.path)
+    for record in run(files, args.benchmarks, args.repeat):
+        print(json.dumps(record), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from itertools import product
+from os import makedirs
+from os.path import isfile, join
+
+import numpy as np
+import tifffile
+
+# the scaling matrix: every combination of these is a file in the corpus
+pages = (1, 100, 1000)
+layouts = ('strips', 'tiles', 'pyramid')
+formats = ('classic', 'bigtiff')
+byteorders = ('<', '>')
+tagsizes = (0, 2 ** 10, 2 ** 16)  # length of an extra out-of-line tag array on each page
+limit = 2 ** 24  # combinations with more than this number of tag array values in total are left out
+
+
+def get_name(n_pages, layout, fmt, byteorder, tagsize):
+    return f'{n_pages}p_{layout}_{fmt}_{"le" if byteorder == "<" else "be"}_{tagsize}t.tif'
+
+
+def get_params(name):
+    """ Inverse of get_name """
+    n_pages, layout, fmt, byteorder, tagsize = name[:-4].split('_')
+    return {'pages': int(n_pages[:-1]), 'layout': layout, 'format': fmt, 'byteorder': byteorder,
+            'tagsize': int(tagsize[:-1])}
+
+
+def write(file, n_pages, layout, fmt, byteorder, tagsize, shape=(64, 64), seed=0):
+    """ Writes a small, reproducible tiff: strips of 4 rows, 16x16 tiles or a pyramid of 2 sub ifds per page,
+        optionally with a private tag (65000) holding an array of tagsize longs
+    """
+    rng = np.random.default_rng(seed)
+    extratags = [(65000, 'I', tagsize, np.arange(tagsize, dtype='uint32'), False)] if tagsize else []
+    kwargs = {'tile': (16, 16)} if layout == 'tiles' else {'rowsperstrip': 4}
+    with tifffile.TiffWriter(file, bigtiff=fmt == 'bigtiff', byteorder=byteorder) as tif:
+        for _ in range(n_pages):
+            im = rng.integers(0, 256, shape, 'uint8')
+            if layout == 'pyramid':
+                tif.write(im, subifds=2, extratags=extratags, **kwargs)
+                tif.write(im[::2, ::2], subfiletype=1, **kwargs)
+                tif.write(im[::4, ::4], subfiletype=1, **kwargs)
+            else:
+                tif.write(im, extratags=extratags, **kwargs)
+
+
+def generate(path, pages=pages, layouts=layouts, formats=formats, byteorders=byteorders, tagsizes=tagsizes,
+             overwrite=False):
+    """ Writes the corpus to path and returns the files in it, existing files are kept unless overwrite """
+    makedirs(path, exist_ok=True)
+    files = []
+    for params in product(pages, layouts, formats, byteorders, tagsizes):
+        if params[0] * params[-1] > limit:
+            continue
+        file = join(path, get_name(*params))
+        if overwrite or not isfile(file):
+            write(file, *params)
+        files.append(file)
+    return files
+
+
+def main():
+    parser = ArgumentParser(description='Write a synthetic corpus of tiff files for benchmarking.')
+    parser.add_argument('path', help='directory to write the corpus in')
+    parser.add_argument('--pages', type=int, nargs='+', default=pages, help='numbers of pages')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite existing files')
+    args = parser.parse_args()
+    for file in generate(args.path, args.pages, overwrite=args.overwrite):
+        print(file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import struct
+import time
+
+import numpy as np
+import tifffile
+
+from tiffexplore import audit, tiffread
+
+
+def test_loop(tmp_path):
+    file = str(tmp_path / 'loop.tif')
+    tifffile.imwrite(file, np.zeros((3, 8, 8), 'uint8'), photometric='minisblack')
+    with tiffread.tiff(file) as tiff:
+        offset, length = tiff.addresses[('ifd', (2,))]
+    with open(file, 'r+b') as f:  # let the last ifd point back to the first
+        f.seek(offset + length - 4)
+        f.write(struct.pack('<I', 8))
+    record = audit.audit(file, timeout=10)
+    assert 'error' not in record
+    assert record['n_ifds'] == 3
+
+
+def test_sub_ifd_loop(tmp_path):
+    file = str(tmp_path / 'subloop.tif')
+    with tifffile.TiffWriter(file) as tif:
+        tif.write(np.zeros((16, 16), 'uint8'), subifds=1)
+        tif.write(np.zeros((8, 8), 'uint8'), subfiletype=1)
+    with tiffread.tiff(file) as tiff:
+        address = tiff.tags[(0,)][330].address
+    with open(file, 'r+b') as f:  # let the sub ifd pointer point to the ifd itself
+        f.seek(address)
+        f.write(struct.pack('<I', 8))
+    record = audit.audit(file, timeout=10)
+    assert 'error' not in record
+    assert record['n_ifds'] == 1
+
+
+def test_not_a_tiff(tmp_path):
+    file = tmp_path / 'text.tif'
+    file.write_bytes(b'not a tiff file')
+    assert audit.audit(str(file))['error'] == 'ValueError: Not a TIFF-file'
+
+
+def test_timeout(tmp_path, monkeypatch):
+    file = str(tmp_path / 'image.tif')
+    tifffile.imwrite(file, np.zeros((8, 8), 'uint8'))
+    monkeypatch.setattr(audit, 'layout', lambda *args: time.sleep(10))
+    start = time.time()
+    assert audit.audit(file, timeout=0.2)['error'].startswith('TimeoutError')
+    assert time.time() - start < 5
+
+
+def test_pyramid(tmp_path):
+    """ tifffile chains the levels it also lists in SubIFDs, which does not make them shared """
+    file = str(tmp_path / 'pyramid.tif')
+    with tifffile.TiffWriter(file) as tif:
+        tif.write(np.zeros((64, 64), 'uint8'), subifds=2, tile=(16, 16))
+        for level in (1, 2):
+            tif.write(np.zeros((64 // 2 ** level,) * 2, 'uint8'), subfiletype=1, tile=(16, 16))
+    record = audit.audit(file, timeout=10)
+    assert record['n_ifds'] == 3
+    assert record['n_identical_regions'] == record['n_duplicated_images'] == record['n_overlaps'] == 0
+
+
+def test_duplicated_images(tmp_path):
+    file = str(tmp_path / 'shared.tif')
+    tifffile.imwrite(file, np.zeros((2, 64, 64), 'uint8'), photometric='minisblack', rowsperstrip=8)
+    with tiffread.tiff(file) as tiff:
+        first, second = tiff.addresses[('tagdata', (0, 273))], tiff.addresses[('tagdata', (1, 273))]
+        offsets = bytes(tiff.read(*first))
+    with open(file, 'r+b') as f:  # let the strips of the second page be those of the first
+        f.seek(second[0])
+        f.write(offsets)
+    record = audit.audit(file, timeout=10)
+    assert record['n_duplicated_images'] == 8
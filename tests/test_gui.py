@@ -0,0 +1,125 @@
+import os
+import time
+
+import numpy as np
+import pytest
+import tifffile
+
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from tiffexplore import gui  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+@pytest.fixture
+def window(app, tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    window = gui.App()
+    yield window
+    window.close()
+
+
+def write(file, n, append=False, shape=(64, 64)):
+    with tifffile.TiffWriter(file, append=append) as tif:
+        for i in range(n):
+            tif.write(np.full(shape, i % 256, 'uint8'), rowsperstrip=4)
+
+
+def wait(app, window, timeout=60):
+    start = time.time()
+    while not window.tiff.done.is_set() or window.tiff.callback and app.hasPendingEvents():
+        app.processEvents()
+        assert time.time() - start < timeout
+
+
+def assert_fresh(bar):
+    fresh = bar.get_bar(bar.scale)
+    assert list(dict.items(bar.bar)) == list(dict.items(fresh))
+    assert bar.bar.pixels == fresh.pixels
+    assert bar.bar.addrs == fresh.addrs
+    assert bar.bar.outside == fresh.outside
+    assert bar.bar.max_addr == fresh.max_addr
+
+
+def test_scan(app, window, tmp_path):
+    file = str(tmp_path / 'scan.tif')
+    write(file, 2000, shape=(8, 8))
+    window.open(file)
+    wait(app, window)
+    window.update_file(window.tiff)
+    assert_fresh(window.bar)
+
+
+def test_follow(app, window, tmp_path):
+    file = str(tmp_path / 'follow.tif')
+    write(file, 10, shape=(16, 16))
+    window.open(file)
+    wait(app, window)
+    window.update_file(window.tiff)
+    groups = sum(key[0] == 'group' for key in window.bar.bar)
+    for _ in range(10):
+        write(file, 1, True, (16, 16))
+        assert window.tiff.update() is not None
+        window.update_file(window.tiff)
+        assert_fresh(window.bar)
+    assert sum(key[0] == 'group' for key in window.bar.bar) > groups
+
+
+def test_goto(app, window, tmp_path):
+    file = str(tmp_path / 'goto.tif')
+    write(file, 10)
+    window.open(file)
+    wait(app, window)
+    binary = window.binary
+    for text, offset in (('99999999999999', len(window.tiff) - 1), ('-5', 0), ('0x100', 256)):
+        window.goto.setText(text)
+        window.gotoOffset()
+        assert binary.top <= offset // binary.rowsize < binary.top + binary.visible_rows()
+
+
+class large():
+    """ a file too large for the rows to fit in the range of a scrollbar """
+    def __len__(self):
+        return 2 ** 40
+
+
+def test_goto_large(app, window):
+    binary, scrollbar = window.binary, window.binary.verticalScrollBar()
+    binary.tiff = large()
+    binary.update_scrollbar()
+    assert 0 < scrollbar.maximum() <= 2 ** 31 - 1
+    binary.goto(2 ** 39 + 100)
+    assert binary.top == (2 ** 39 + 100) // binary.rowsize
+    binary.goto(2 ** 50)
+    assert binary.top == binary.get_max_top() == 2 ** 40 // binary.rowsize - binary.visible_rows()
+    scrollbar.setValue(scrollbar.maximum() // 2)
+    assert abs(binary.top - binary.get_max_top() // 2) <= binary.get_scale()
+    binary.tiff = None
+
+
+def test_tag_count(app, tmp_path):
+    file = str(tmp_path / 'tags.tif')
+    tifffile.imwrite(file, np.zeros((64, 64), 'uint8'), description='hello', metadata=None, rowsperstrip=1,
+                     extratags=[(65000, 'H', 100, np.arange(100, dtype='uint16'), False)])
+    model = gui.TagModel()
+    with gui.tiffread.tiff(file) as tiff:
+        model.set_tags(tiff.tags[(0,)])
+        rows = {code: row for row, code in enumerate(tiff.tags[(0,)].codes)}
+        count = {code: model.data(model.index(row, model.columns.index('Count'))) for code, row in rows.items()}
+        assert count[270] == '6' and count[305] == str(len(tiff.tags[(0,)][305].value) + 1)
+        assert count[273] == '64' and count[65000] == '100'
+        assert model.rowCount(model.index(rows[65000], 0)) == 1
+        assert model.rowCount(model.index(rows[270], 0)) == 0
+
+
+@pytest.mark.parametrize('size', [90, 99, 110, 1000, 4097])
+def test_preview_fits(size):
+    for shape in ((10, 10), (10, 37), (1, 1), (11, 9)):
+        for im in (np.zeros((size, size)), np.zeros((size, size // 2 + 1, 3)), np.zeros(size)):
+            preview = gui.Preview.get_preview(im, shape, 0, 1)
+            assert preview.shape[0] <= shape[0] and preview.shape[1] <= shape[1]
@@ -0,0 +1,123 @@
+import struct
+import warnings
+
+import numpy as np
+import pytest
+import tifffile
+
+from tiffexplore import tiffread
+
+
+def write(file, bigtiff=False, byteorder='<', tile=None):
+    """ rgb pages with a pyramid of sub ifds and a user description, next to the one tifffile writes """
+    with tifffile.TiffWriter(file, bigtiff=bigtiff, byteorder=byteorder) as tif:
+        for i in range(2):
+            image = np.arange(3 * 64 * 64, dtype='uint16').reshape((64, 64, 3)) + i
+            tif.write(image, photometric='rgb', tile=tile, subifds=2, description=f'page {i}',
+                      extratags=[(65000, 'd', 20, np.arange(20) / 3, False)])
+            for level in (1, 2):
+                tif.write(image[::2 ** level, ::2 ** level], photometric='rgb', tile=tile, subfiletype=1)
+
+
+def get_tags(t):
+    """ all entries of all ifds, the values of those pointing to image data or sub ifds are not compared """
+    tags = []
+    for idx in t.iter_ifds():
+        table = t.tags[idx]
+        for row, code in sorted(enumerate(table.codes), key=lambda item: item[1]):
+            if code not in t.dropped:
+                tag = table.record(row)
+                value = None if code in t.relocated or code in t.subifdcodes else \
+                    tag.value if isinstance(tag.value, (str, bytes)) else tag.value.tolist()
+                tags.append((idx, code, tag.ttype if value is not None else None, value))
+    return tags
+
+
+def get_images(t):
+    return {idx: [bytes(t.read(*segment)) for segment in zip(*(a.tolist() for a in arrays))]
+            for (_, idx), arrays in t.addresses.arrays.items()}
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+@pytest.mark.parametrize('byteorder', ['<', '>'])
+@pytest.mark.parametrize('tile', [None, (16, 16)])
+def test_repack(tmp_path, bigtiff, byteorder, tile):
+    file, repacked = str(tmp_path / 'file.tif'), str(tmp_path / 'repacked.tif')
+    write(file, bigtiff, byteorder, tile)
+    with tiffread.tiff(file) as t, warnings.catch_warnings():
+        warnings.simplefilter('error')
+        t.repack(repacked)
+        with tiffread.tiff(repacked) as r:
+            assert r.bigtiff == bigtiff and r.byteorder == byteorder
+            assert list(r.iter_ifds()) == list(t.iter_ifds())
+            assert get_tags(r) == get_tags(t)
+            assert get_images(r) == get_images(t)
+            assert r.get_fragmentation()['unused_bytes'] <= t.get_fragmentation()['unused_bytes']
+    with tifffile.TiffFile(file) as tif, tifffile.TiffFile(repacked) as rif:
+        assert len(rif.pages) == len(tif.pages) == 2
+        for page, repage in zip(tif.pages, rif.pages):
+            assert repage.description == page.description
+            assert repage.tags[270].value == page.tags[270].value
+            assert len(repage.subifds) == 2
+        for series, reseries in zip(tif.series, rif.series):
+            assert len(reseries.levels) == len(series.levels) == 3
+            for level, relevel in zip(series.levels, reseries.levels):
+                np.testing.assert_array_equal(relevel.asarray(), level.asarray())
+
+
+def test_repack_unknown_type(tmp_path):
+    file, repacked = str(tmp_path / 'file.tif'), str(tmp_path / 'repacked.tif')
+    with tifffile.TiffWriter(file) as tif:
+        tif.write(np.zeros((8, 8), 'uint8'), extratags=[(65000, 'H', 1, 7, False)])
+    with tiffread.tiff(file) as t:
+        row = t.tags[(0,)].find(65000)
+        entry = t.offsets[(0,)] + struct.calcsize(t.tagnoformat) + row * t.tagsize
+    with open(file, 'r+b') as fh:
+        fh.seek(entry + 2)
+        fh.write(struct.pack('<H', 99))
+    with tiffread.tiff(file) as t, pytest.warns(UserWarning, match='unknown type 99'):
+        t.repack(repacked)
+    with tiffread.tiff(repacked) as r:
+        tag = r.tags[(0,)][65000]
+        assert tag.ttype == 99 and tag.value[:2] == struct.pack('<H', 7)
+
+
+def test_repack_in_place(tmp_path):
+    file = str(tmp_path / 'file.tif')
+    with tifffile.TiffWriter(file) as tif:
+        for i in range(3):
+            tif.write(np.full((64, 64), i, 'uint8'), rowsperstrip=8, description=f'page {i}')
+    with tiffread.tiff(file) as t:
+        t.repack(file)
+        assert bytes(t[:2]) == b'II'  # the memory map of the original is still valid
+    with tifffile.TiffFile(file) as tif:
+        assert len(tif.pages) == 3
+        for i, page in enumerate(tif.pages):
+            assert (page.asarray() == i).all()
+            assert page.description == f'page {i}'
+
+
+def test_repack_jpeg_interchange(tmp_path):
+    """ JPEGInterchangeFormat and its length are moved like strips, JPEG tables cannot be moved and give a warning """
+    file, repacked = str(tmp_path / 'file.tif'), str(tmp_path / 'repacked.tif')
+    stream = bytes(range(200))
+    with tifffile.TiffWriter(file) as tif:
+        tif.write(np.zeros((8, 8), 'uint8'), extratags=[(513, 'I', 1, 0, False), (514, 'I', 1, len(stream), False),
+                                                         (65000, 'B', len(stream), stream, False)])
+    with tiffread.tiff(file) as t:
+        address = t.tags[(0,)][513].address
+        offset = t.tags[(0,)][65000].address
+    with open(file, 'r+b') as fh:
+        fh.seek(address)
+        fh.write(struct.pack('<I', offset))
+    with tiffread.tiff(file) as t, warnings.catch_warnings():
+        warnings.simplefilter('error')
+        t.repack(repacked)
+    with tiffread.tiff(repacked) as r:
+        tags = r.tags[(0,)]
+        assert bytes(r.read(tags[513].value[0], tags[514].value[0])) == stream
+
+    with tifffile.TiffWriter(file) as tif:
+        tif.write(np.zeros((8, 8), 'uint8'), extratags=[(519, 'I', 1, 8, False)])
+    with tiffread.tiff(file) as t, pytest.warns(UserWarning, match='JPEG tables'):
+        t.repack(repacked)
@@ -0,0 +1,192 @@
+from itertools import islice
+
+import numpy as np
+import pytest
+import tifffile
+
+from tiffexplore import tiffread
+
+
+@pytest.fixture
+def file(tmp_path):
+    file = tmp_path / 'strips.tif'
+    with tifffile.TiffWriter(file) as tif:
+        for i in range(3):
+            tif.write(np.full((64, 64), i, 'uint8'), rowsperstrip=8, description=f'page {i}')
+    return str(file)
+
+
+@pytest.mark.parametrize('step', [None, 1, 3, 100, 1000])
+def test_getitem(file, step):
+    with tiffread.tiff(file) as mapped, tiffread.tiff(file, memmap=False) as unmapped:
+        unmapped.chunksize = 1000
+        for start, stop in ((0, None), (5, 17), (17, 5), (-3, 4000), (1000, len(mapped) + 10)):
+            assert bytes(mapped[start:stop:step]) == bytes(unmapped[start:stop:step])
+        assert bytes(unmapped[7]) == bytes(mapped[7])
+
+
+def test_layoutcache(file, tmp_path):
+    cache = tiffread.layoutcache(str(tmp_path / 'cache'))
+    with tiffread.tiff(file, cache=cache) as parsed, tiffread.tiff(file, cache=cache, stats=True) as cached:
+        assert 'ifd chain' not in cached.stats.times
+        assert cached.offsets == parsed.offsets and cached.nTags == parsed.nTags
+        assert dict(cached.addresses) == dict(parsed.addresses)
+        assert {key: [a.tolist() for a in arrays] for key, arrays in cached.addresses.arrays.items()} == \
+            {key: [a.tolist() for a in arrays] for key, arrays in parsed.addresses.arrays.items()}
+        assert list(cached.addresses.get_assignments()) == list(parsed.addresses.get_assignments())
+        for idx, tags in parsed.tags.items():
+            assert [(code, repr(tag)) for code, tag in tags.items()] == \
+                [(code, repr(tag)) for code, tag in cached.tags[idx].items()]
+
+
+@pytest.fixture
+def pyramid(tmp_path):
+    """ tifffile lists the sub ifds of a page in its SubIFDs tag and also chains them """
+    file = str(tmp_path / 'pyramid.tif')
+    with tifffile.TiffWriter(file) as tif:
+        for i in range(4):
+            tif.write(np.full((64, 64), i, 'uint8'), subifds=2, tile=(16, 16))
+            for level in (1, 2):
+                tif.write(np.full((64 // 2 ** level,) * 2, i, 'uint8'), subfiletype=1, tile=(16, 16))
+    return file
+
+
+@pytest.mark.parametrize('workers', [1, 8])
+def test_pyramid(pyramid, workers):
+    with tiffread.tiff(pyramid, workers=workers) as t:
+        assert len(t.nTags) == len({t.offsets[idx] for idx in t.nTags}) == 12
+        assert sorted(t.iter_ifds()) == sorted(t.nTags)
+        assert not t.addresses.get_overlaps()['identical']
+
+
+def test_workers(pyramid):
+    with tiffread.tiff(pyramid, workers=1) as single:
+        for _ in range(20):
+            with tiffread.tiff(pyramid, workers=8) as concurrent:
+                assert concurrent.offsets == single.offsets
+                assert list(concurrent.addresses.get_assignments()) == list(single.addresses.get_assignments())
+
+
+def test_get_overlaps():
+    regions = tiffread.assignments(100)
+    regions[('a', (0,))] = (0, 10)
+    regions[('b', (0,))] = (0, 10)
+    regions[('c', (0,))] = (2, 3)
+    regions[('d', (0,))] = (8, 10)
+    regions[('e', (0,))] = (30, 0)
+    regions.add_array(('f', (0,)), [50, 60], [10, 50])
+    regions[('g', (0,))] = (55, 10)
+    overlaps = regions.get_overlaps()
+    a, b, c, d, f0, f1, g = ('a', (0,)), ('b', (0,)), ('c', (0,)), ('d', (0,)), ('f', (0, 0)), ('f', (0, 1)), \
+        ('g', (0,))
+    assert overlaps['identical'] == [[a, b]]
+    assert sorted(overlaps['overlaps']) == sorted([([a, b], [c], 2, 3, 'contained'), ([a, b], [d], 8, 2, 'partial'),
+                                                   ([f0], [g], 55, 5, 'partial'), ([g], [f1], 60, 5, 'partial')])
+    assert overlaps['out_of_bounds'] == [f1]
+
+
+def test_get_overlaps_random():
+    """ against a pairwise comparison of all regions """
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        regions = tiffread.assignments(1000)
+        for i in range(rng.integers(1, 30)):
+            regions[('r', (i,))] = tuple(rng.integers(0, 100, 2).tolist())
+        regions.add_array(('s', (0,)), rng.integers(0, 1000, 10), rng.integers(0, 100, 10))
+        items = [(key, regions[key]) for key in list(dict.keys(regions)) + [('s', (0, i)) for i in range(10)]]
+        distinct = {}
+        for key, value in items:
+            distinct.setdefault(value, []).append(key)
+        expected = set()
+        for (o, n), keys in distinct.items():
+            for (p, m), other in distinct.items():
+                if (o, n) < (p, m) and n and m and max(o, p) < min(o + n, p + m):
+                    kind = 'contained' if o <= p and p + m <= o + n or p <= o and o + n <= p + m else 'partial'
+                    expected.add((frozenset((tuple(keys), tuple(other))), max(o, p), min(o + n, p + m) - max(o, p),
+                                  kind))
+        overlaps = regions.get_overlaps()
+        assert sorted(overlaps['identical']) == sorted(keys for keys in distinct.values() if len(keys) > 1)
+        assert {(frozenset((tuple(a), tuple(b))), offset, length, kind)
+                for a, b, offset, length, kind in overlaps['overlaps']} == expected
+        assert len(overlaps['overlaps']) == len(expected)
+        assert sorted(overlaps['out_of_bounds']) == sorted(key for key, (o, n) in items if o + n > 1000)
+
+
+def get_assignment(items, max_addr, addr):
+    """ the lookup of the original assignments, which searched all regions every time """
+    starts = [offset for _, (offset, _) in items if offset <= addr]
+    if starts:
+        first = [(key, value) for key, value in items if value[0] == max(starts)]
+        if addr < sum(first[0][1]):
+            return first
+    previous_addr = max([sum(value) for _, value in items if sum(value) <= addr], default=0)
+    next_addr = min([offset for _, (offset, _) in items if offset > addr], default=max_addr)
+    return [(('empty',), (previous_addr, next_addr - previous_addr))]
+
+
+def get_assignments(items, max_addr, start=0):
+    addr = start
+    while addr < max_addr:
+        item = get_assignment(items, max_addr, addr)
+        addr = sum(item[0][1])
+        yield item
+
+
+def add_regions(regions, rng, n):
+    """ adds regions, often at the same offsets, and arrays of regions, sometimes replaces a region """
+    if len(regions) and rng.integers(4) == 0:  # the index is built again
+        regions[next(iter(dict.keys(regions)))] = tuple(rng.integers(0, 50, 2).tolist())
+    for i in range(rng.integers(n)):
+        regions[('r', (len(regions), i))] = tuple(rng.integers(0, 50, 2).tolist())
+    for i in range(rng.integers(3)):
+        size = int(rng.integers(1, 10))
+        regions.add_array(('s', (len(regions.arrays),)), rng.integers(0, 60, size), rng.integers(0, 10, size))
+
+
+def get_items(regions):
+    """ the regions with those of the arrays after the others """
+    return list(dict.items(regions)) + [((code, (*idx, i)), value) for (code, idx), arrays in regions.arrays.items()
+                                        for i, value in enumerate(zip(*(a.tolist() for a in arrays)))]
+
+
+def test_assignments():
+    """ against the original implementation, also when regions are added after the index is built or while walking
+    """
+    rng = np.random.default_rng(0)
+    tiffread.regionindex.blocksize = 4  # walks cross many blocks
+    try:
+        for _ in range(200):
+            regions = tiffread.assignments(64)
+            add_regions(regions, rng, 20)
+            for _ in range(4):
+                items = get_items(regions)
+                for addr in range(66):
+                    assert regions.get_assignment(addr) == get_assignment(items, 64, addr)
+                assert list(regions.get_assignments()) == list(get_assignments(items, 64))
+                walk = regions.get_assignments()
+                addr = sum(list(islice(walk, int(rng.integers(1, 4))))[-1][0][1])
+                add_regions(regions, rng, 5)  # merged into the index while walking
+                assert list(walk) == list(get_assignments(get_items(regions), 64, addr))
+    finally:
+        tiffread.regionindex.blocksize = 2 ** 10
+
+
+@pytest.mark.parametrize('kwargs', [{'rowsperstrip': 5}, {'rowsperstrip': 8, 'compression': 'zlib'},
+                                    {'tile': (16, 16)}, {'tile': (16, 32), 'compression': 'zlib'},
+                                    {'photometric': 'rgb', 'planarconfig': 'separate', 'rowsperstrip': 7},
+                                    {'photometric': 'rgb', 'planarconfig': 'contig', 'tile': (16, 16)}])
+@pytest.mark.parametrize('byteorder', ['<', '>'])
+def test_asarray(tmp_path, kwargs, byteorder):
+    """ segments decoded one at a time, through a private method of tifffile, like tifffile decodes them """
+    file = str(tmp_path / 'segments.tif')
+    shape = (3, 37, 45) if kwargs.get('planarconfig') == 'separate' else \
+        (37, 45, 3) if 'photometric' in kwargs else (37, 45)
+    with tifffile.TiffWriter(file, byteorder=byteorder) as tif:
+        for i in range(2):
+            tif.write(np.arange(np.prod(shape), dtype='uint16').reshape(shape) + i, **kwargs)
+    with tiffread.tiff(file) as t, tifffile.TiffFile(file) as tif:
+        for page in range(2):
+            segments = list(tif.pages[page].segments(sort=True))
+            assert len(segments) == len(t.addresses.arrays[('image', (page,))][0]) > 1
+            for i, (data, _, _) in enumerate(segments):
+                np.testing.assert_array_equal(t.asarray(page, i), data.squeeze())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import json
+import signal
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stdout
+from functools import partial
+from glob import has_magic, iglob
+from os import cpu_count, walk
+from os.path import isdir, isfile, join, splitext
+from traceback import format_exc
+
+if __package__ is None or __package__ == '':
+    import tiffread
+else:
+    from . import tiffread
+
+extensions = ('.tif', '.tiff', '.btf', '.tf8', '.dng')
+
+
+def find_files(paths, extensions=extensions):
+    """ Yields the files in paths, which can be files, globs or directories, directories are searched recursively
+        for files with one of the extensions
+    """
+    for path in paths:
+        for path in (iglob(path, recursive=True) if has_magic(path) else (path,)):
+            if isdir(path):
+                for root, _, files in walk(path):
+                    for file in sorted(files):
+                        if splitext(file)[1].lower() in extensions:
+                            yield join(root, file)
+            elif isfile(path):
+                yield path
+
+
+def layout(tiff, regions=True):
+    """ Summary of the layout of a parsed tiff as a json serializable dict """
+    n_regions, n_shared, region_map = 0, 0, []
+    for item in tiff.addresses.get_assignments():
+        n_regions += 1
+        n_shared += len(item) > 1
+        if regions:
+            for (code, *key), (offset, length) in item:
+                region_map.append([code, list(key[0]) if key else None, int(offset), int(length)])
+    ifds = [offset for (code, _), (offset, _) in tiff.addresses.items() if code in ('ifd', 'subifd')]
+    images = [offsets for (code, _), (offsets, _) in tiff.addresses.arrays.items() if code == 'image' and len(offsets)]
+    if not ifds or not images:
+        placement = None
+    elif max(ifds) < min(offsets.min() for offsets in images):
+        placement = 'before images'
+    elif min(ifds) > max(offsets.max() for offsets in images):
+        placement = 'after images'
+    else:
+        placement = 'interleaved'
+    overlaps = tiff.addresses.get_overlaps()
+    record = {'size': len(tiff), 'byteorder': tiff.byteorder, 'bigtiff': tiff.bigtiff, 'offsetsize': tiff.offsetsize,
+              'first_ifd': tiff.offsets.get((0,)), 'n_ifds': len(tiff.nTags),
+              'tags': [[list(idx), n] for idx, n in tiff.nTags.items()], 'unused_bytes': int(tiff.get_empty()),
+              'n_regions': n_regions, 'n_shared_regions': n_shared, 'ifd_placement': placement,
+              'n_identical_regions': len(overlaps['identical']), 'n_overlaps': len(overlaps['overlaps']),
+              'n_partial_overlaps': sum(overlap[-1] == 'partial' for overlap in overlaps['overlaps']),
+              'n_duplicated_images': sum(keys[0][0] == 'image' for keys in overlaps['identical']),
+              'out_of_bounds': [[code, list(key)] for code, key in overlaps['out_of_bounds']]}
+    if regions:
+        record['regions'] = region_map
+    return record
+
+
+def raise_timeout(seconds, signum, frame):
+    raise TimeoutError(f'auditing took more than {seconds} s')
+
+
+def audit(file, regions=True, cache=None, stats=False, timeout=None):
+    """ Parses file and returns its layout record, parse errors are printed to stderr and stored in the record
+        cache: None, True for the default layout cache, or the directory of the layout cache to use
+        stats: add the counts of reads and the times of the phases of parsing to the record
+        timeout: stop after this many seconds with a TimeoutError in the record, only where there is SIGALRM and in
+            the main thread, as in the processes of audit_files
+    """
+    record = {'file': file}
+    alarm = timeout and hasattr(signal, 'SIGALRM')
+    try:
+        if alarm:
+            signal.signal(signal.SIGALRM, partial(raise_timeout, timeout))
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        with redirect_stdout(sys.stderr):
+            with tiffread.tiff(file, workers=1, cache=tiffread.layoutcache(cache) if isinstance(cache, str)
+                               else cache, stats=stats, strict=True) as tiff:
+                record.update(layout(tiff, regions))
+                if stats:
+                    record['stats'] = tiff.stats.asdict()
+    except Exception:
+        record['error'] = format_exc().strip().splitlines()[-1]
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return record
+
+
+def audit_files(files, processes=None, regions=True, cache=None, stats=False, timeout=None):
+    """ Yields the layout records of files in the order in which they are done, at most 2 * processes files are
+        in flight at any time so that memory use does not depend on the number of files
+        timeout: seconds after which auditing a file is stopped, see audit
+    """
+    processes = processes or cpu_count() or 1
+    files = iter(files)
+    with ProcessPoolExecutor(processes) as executor:
+        futures = set()
+        for file in files:
+            futures.add(executor.submit(audit, file, regions, cache, stats, timeout))
+            if len(futures) >= 2 * processes:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                yield from (future.result() for future in done)
+        for future in futures:
+            yield future.result()
+
+
+def main():
+    parser = ArgumentParser(description='Audit the layout of tiff files, writes one json record per file to stdout.')
+    parser.add_argument('paths', nargs='+', help='files, globs or directories to search for tiff files')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='number of processes, default: cpu count')
+    parser.add_argument('-e', '--extensions', nargs='+', default=extensions,
+                        help=f'extensions of files to search for in directories, default: {" ".join(extensions)}')
+    parser.add_argument('--no-regions', action='store_true', help='leave the map of regions out of the records')
+    parser.add_argument('--cache', nargs='?', const=True, default=None,
+                        help='use a cache of parsed layouts, optionally in this directory')
+    parser.add_argument('--stats', action='store_true', help='add counts of reads and times of parsing phases')
+    parser.add_argument('-t', '--timeout', type=float, default=300,
+                        help='seconds after which auditing a file is stopped, 0: no timeout, default: 300')
+    args = parser.parse_args()
+    files = find_files(args.paths, tuple(e.lower() for e in args.extensions))
+    for record in audit_files(files, args.processes, not args.no_regions, args.cache, args.stats, args.timeout):
+        print(json.dumps(record), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,811 @@
+#!/usr/bin/env python3
+
+from PyQt5 import QtCore, QtWidgets, QtGui
+import struct
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tifffile
+from os.path import isfile, basename, samefile
+from sys import argv
+
+if __package__ is None:
+    import tiffread
+else:
+    from . import tiffread
+
+
+class UiMainWindow(object):
+    def setupUi(self, MainWindow):
+        MainWindow.resize(800, 600)
+        self.centralwidget = QtWidgets.QWidget(MainWindow)
+        self.centrallayout = QtWidgets.QHBoxLayout(self.centralwidget)
+        self.scrollArea = QtWidgets.QScrollArea(self.centralwidget)
+        self.scrollArea.setFixedWidth(150)
+        self.scrollArea.setMinimumHeight(200)
+        self.scrollArea.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
+        self.scrollArea.setWidgetResizable(True)
+        self.leftcolumnWidget = QtWidgets.QWidget()
+        self.leftcolumnWidget.setFixedWidth(130)
+        self.leftcolumnWidget.setMinimumHeight(200)
+        self.verticalLayoutWidget = QtWidgets.QWidget(self.leftcolumnWidget)
+        self.verticalLayoutWidget.setFixedWidth(130)
+        self.verticalLayoutWidget.setMinimumHeight(200)
+        self.leftcolumn = QtWidgets.QVBoxLayout(self.verticalLayoutWidget)
+        self.leftcolumn.setContentsMargins(0, 0, 0, 0)
+        self.scrollArea.setWidget(self.leftcolumnWidget)
+        self.middlecolumnWidget = QtWidgets.QWidget()
+        self.middlecolumn = QtWidgets.QVBoxLayout(self.middlecolumnWidget)
+        self.middlecolumn.setContentsMargins(0, 0, 0, 0)
+        self.properties = QtWidgets.QTextEdit(self.centralwidget)
+        self.properties.setReadOnly(True)
+        self.middlecolumn.addWidget(self.properties)
+        self.tagview = QtWidgets.QTreeView(self.centralwidget)
+        self.tagview.setUniformRowHeights(True)
+        self.middlecolumn.addWidget(self.tagview)
+        self.rightcolumnWidget = QtWidgets.QWidget()
+        self.rightcolumn = QtWidgets.QVBoxLayout(self.rightcolumnWidget)
+        self.rightcolumn.setContentsMargins(0, 0, 0, 0)
+        self.goto = QtWidgets.QLineEdit(self.rightcolumnWidget)
+        self.goto.setPlaceholderText('Go to offset')
+        self.rightcolumn.addWidget(self.goto)
+        self.binary = HexView(self.rightcolumnWidget)
+        self.rightcolumn.addWidget(self.binary)
+        self.image = QtWidgets.QLabel(self.rightcolumnWidget)
+        self.image.setMinimumWidth(200)
+        self.image.setMinimumHeight(200)
+        self.rightcolumn.addWidget(self.image)
+        MainWindow.setCentralWidget(self.centralwidget)
+        self.menubar = QtWidgets.QMenuBar(MainWindow)
+        self.menubar.setGeometry(QtCore.QRect(0, 0, 800, 22))
+        self.menubar.setObjectName("menubar")
+        self.menuFile = QtWidgets.QMenu(self.menubar)
+        self.menuFile.setObjectName("menuFile")
+        MainWindow.setMenuBar(self.menubar)
+        self.statusbar = QtWidgets.QStatusBar(MainWindow)
+        self.statusbar.setObjectName("statusbar")
+        MainWindow.setStatusBar(self.statusbar)
+        self.actionOpen = QtWidgets.QAction(MainWindow)
+        self.actionOpen.setObjectName("actionOpen")
+        self.menuFile.addAction(self.actionOpen)
+        self.actionRepack = QtWidgets.QAction(MainWindow)
+        self.actionRepack.setObjectName("actionRepack")
+        self.menuFile.addAction(self.actionRepack)
+        self.actionFollow = QtWidgets.QAction(MainWindow)
+        self.actionFollow.setObjectName("actionFollow")
+        self.actionFollow.setCheckable(True)
+        self.menuFile.addAction(self.actionFollow)
+        self.menubar.addAction(self.menuFile.menuAction())
+        self.centrallayout.addWidget(self.scrollArea)
+        self.centrallayout.addWidget(self.middlecolumnWidget)
+        self.centrallayout.addWidget(self.rightcolumnWidget)
+        self.centralwidget.setLayout(self.centrallayout)
+        self.retranslateUi(MainWindow)
+        QtCore.QMetaObject.connectSlotsByName(MainWindow)
+
+    def retranslateUi(self, MainWindow):
+        _translate = QtCore.QCoreApplication.translate
+        MainWindow.setWindowTitle(_translate("MainWindow", "TiffExp"))
+        self.menuFile.setTitle(_translate("MainWindow", "File"))
+        self.actionOpen.setText(_translate("MainWindow", "Open"))
+        self.actionOpen.setShortcut(_translate("MainWindow", "Ctrl+O"))
+        self.actionRepack.setText(_translate("MainWindow", "Repack"))
+        self.actionFollow.setText(_translate("MainWindow", "Follow"))
+
+
+class PaintBox(QtWidgets.QWidget):
+    def drawText(self, qp, rect, text):
+        qp.setPen(QtGui.QColor('black'))
+        qp.setFont(QtGui.QFont('Decorative', 10 if rect[3] > 20 else rect[3] // 2))
+        qp.drawText(QtCore.QRect(*rect), QtCore.Qt.AlignCenter, text)
+
+    def drawRectangle(self, qp, rect, color):
+        color = QtGui.QColor(color) if isinstance(color, str) else QtGui.QColor(*color)
+        qp.setPen(QtGui.QColor('gray'))
+        qp.setBrush(color)
+        qp.drawRect(*rect)
+
+class Legend(PaintBox):
+    def __init__(self, parent):
+        self.parent = parent
+        self.color = {'header': 'red', '(sub)ifd': 'cyan', 'tagdata': 'lightgreen', 'image': 'yellow', 'empty': 'white',
+                      'shared tagdata': 'green', 'shared image': 'orange', 'out of bounds': 'magenta',
+                      'many regions': 'lightgray', 'unknown': 'gray'}
+        super().__init__()
+        self.setFixedHeight(15 * len(self.color))
+        self.show()
+
+    def paintEvent(self, *args, **kwargs):
+        qp = QtGui.QPainter()
+        qp.begin(self)
+        for i, (key, value) in enumerate(self.color.items()):
+            self.drawRectangle(qp, (0, 15*i, 125, 15), value)
+            self.drawText(qp, (0, 15*i, 125, 15), key)
+        qp.end()
+
+
+class Bar(PaintBox):
+    max_height = 2 ** 24 - 1  # maximum height of a QWidget
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.color = {'header': 'red', 'ifd': 'cyan', 'subifd': 'cyan', 'tagdata': 'lightgreen', 'image': 'yellow',
+                      'empty': 'white', 'HEADER': 'red', 'IFD': 'blue', 'SUBIFD': 'blue', 'TAGDATA': 'green',
+                      'IMAGE': 'orange', 'EMPTY': 'white', 'group': 'lightgray'}
+        self.tiff = None
+        self.scale = 100  # bytes per pixel
+        self.bar = self.empty_bar()
+        super().__init__()
+        self.setFixedWidth(150)
+        self.show()
+
+    @staticmethod
+    def empty_bar():
+        bar = tiffread.assignments()
+        bar.pixels, bar.addrs = [], []  # pixel and byte offsets of the blocks in the bar, in order
+        bar.restarts = []  # for each block the first block of the run of blocks laid out together with it
+        bar.outside = set()  # blocks of regions extending beyond the end of the file
+        bar.file_len = 0
+        bar.rows = None  # offsets, lengths, group and item of the regionindex the bar was laid out from
+        return bar
+
+    def new_file(self):
+        if self.tiff is not self.parent.tiff:
+            self.tiff = self.parent.tiff
+            self.scale = 100
+            self.relayout(0, 0)
+        else:
+            self.relayout(grow=True)
+
+    def relayout(self, addr=None, y=None, grow=False):
+        """ Lays out the bar again at self.scale, keeping byte addr at y pixels from the top of the viewport,
+            by default the byte at the top of the viewport stays there
+            grow: if possible only lay out the part of the bar which changed since it was laid out, see grow_bar
+        """
+        scrollbar = self.parent.scrollArea.verticalScrollBar()
+        if addr is None:
+            addr, y = self.get_addr(scrollbar.value()), 0
+        if self.tiff is None:
+            self.bar = self.empty_bar()
+        else:
+            with self.tiff.lock:
+                if not (grow and self.grow_bar()):
+                    self.bar = self.get_bar(self.scale)
+                while self.bar.max_addr > self.max_height:
+                    self.scale *= 2
+                    self.bar = self.get_bar(self.scale)
+        self.parent.leftcolumnWidget.setFixedHeight(self.bar.max_addr)
+        self.parent.verticalLayoutWidget.setFixedHeight(self.bar.max_addr)
+        scrollbar.setMaximum(max(self.bar.max_addr - scrollbar.pageStep(), 0))
+        scrollbar.setValue(int(self.get_pixel(addr) - y))
+        self.update()
+
+    def grow_bar(self):
+        """ Lays out the bar again from the run of blocks before the first block which can have changed while the
+            file was scanned or followed, so that the runs of small regions are grouped as in a new layout, returns
+            False if the whole bar needs to be laid out again
+        """
+        bar = self.bar
+        if bar.rows is None or len(bar) != len(bar.addrs):
+            return False
+        change = self.get_change()
+        if change is None:
+            return True
+        i = bisect_right(bar.addrs, change) - 1
+        i = bar.restarts[bar.restarts[i] - 1] if i >= 0 and bar.restarts[i] > 0 else 0
+        for key in list(dict.keys(bar))[i:]:
+            del bar[key]
+            bar.outside.discard(key)
+        start = bar.addrs[i] if i < len(bar.addrs) else 0
+        bar.max_addr = bar.pixels[i] if i < len(bar.pixels) else 0
+        del bar.pixels[i:], bar.addrs[i:], bar.restarts[i:]
+        self.bar = self.get_bar(self.scale, bar=bar, start=start)
+        return True
+
+    def get_change(self):
+        """ Lowest address at which the layout of the bar can differ from a new layout, None if it cannot: where the
+            regions, sorted by offset, first differ from those the bar was laid out with, or the end of the file if
+            it changed, moved back to the start of any region containing that address
+        """
+        bar, index = self.bar, self.tiff.addresses.sort()
+        old, new = bar.rows, (index.offsets, index.lengths, index.group, index.item)
+        n = min(len(old[0]), len(new[0]))
+        differ = np.zeros(n, bool)
+        for a, b in zip(old, new):
+            differ |= a[:n] != b[:n]
+        changes = [min(old[0][i], new[0][i]) for i in np.flatnonzero(differ)[:1]]
+        if len(old[0]) != len(new[0]):
+            changes.append((old if len(old[0]) > n else new)[0][n])
+        if len(self.tiff) != bar.file_len:  # the empty space at the end and regions which were beyond the end
+            ends = old[0] + old[1]
+            changes.append(min(ends.max(initial=0), bar.file_len))
+            changes.append(old[0][ends > bar.file_len].min(initial=bar.file_len))
+        if not changes:
+            return None
+        change = min(changes)
+        return int(new[0][(new[0] < change) & (new[0] + new[1] > change)].min(initial=change))
+
+    def get_addr(self, y):
+        """ byte address in the file at pixel y in the bar """
+        return self.interpolate(y, self.bar.pixels, self.bar.addrs, self.bar.max_addr, self.bar.file_len)
+
+    def get_pixel(self, addr):
+        """ pixel in the bar at byte address addr in the file """
+        return self.interpolate(addr, self.bar.addrs, self.bar.pixels, self.bar.file_len, self.bar.max_addr)
+
+    @staticmethod
+    def interpolate(x, xs, ys, x_end, y_end):
+        i = bisect_right(xs, x) - 1
+        if i < 0:
+            return 0
+        next_x, next_y = (xs[i + 1], ys[i + 1]) if i + 1 < len(xs) else (x_end, y_end)
+        return ys[i] + (x - xs[i]) * (next_y - ys[i]) // max(next_x - xs[i], 1)
+
+    def paintEvent(self, event):
+        qp = QtGui.QPainter()
+        qp.begin(self)
+        rect = event.rect()
+        for ((key, value), *_) in self.bar.get_assignments(rect.top(), rect.bottom() + 1):
+            if len(key) > 1:
+                text = f'{key[1][2]} regions' if key[0] == 'group' else ' '.join([f'{k}' for k in key[1]])
+                self.drawRectangle(qp, (0, value[0], 125, value[1]),
+                                   'magenta' if key in self.bar.outside else self.color.get(key[0], "gray"))
+                self.drawText(qp, (0, value[0], 125, value[1]), key[0].lower() + ('\n' if value[1] > 20 else ' ') + text)
+        qp.end()
+
+    def get_bar(self, scale=100, min_size=10, max_size=1000, lod=10, max_run=1000, max_pending=2 ** 12, bar=None,
+                start=0):
+        """ Lays out the regions in the file as blocks of min_size to max_size pixels at scale bytes per pixel,
+            runs of small regions taking more than max_run pixels and more than lod times the space they would take
+            at scale are combined into groups of at least min_size pixels, runs are laid out in parts of at most
+            max_pending regions, which also bounds the part of the bar grow_bar lays out again
+            bar, start: continue laying out bar with the regions from address start onwards
+        """
+        if bar is None:
+            bar = self.empty_bar()
+        run = []
+        overlaps = self.tiff.addresses.get_overlaps()
+        shared = {key for keys in overlaps['identical'] for key in keys}
+        shared.update(key for overlap in overlaps['overlaps'] for keys in overlap[:2] for key in keys)
+        outside = set(overlaps['out_of_bounds'])
+
+        def add(key, offset, length, restart=None):
+            size = min(max(length // scale, min_size), max_size)
+            bar.restarts.append(len(bar.pixels) if restart is None else restart)
+            bar.pixels.append(bar.max_addr)
+            bar.addrs.append(offset)
+            bar[key] = (bar.max_addr, size)
+            bar.max_addr += size
+
+        def flush():
+            if not run:
+                return
+            restart = len(bar.pixels)
+            if len(run) * min_size <= max(lod * max((sum(run[-1][1:]) - run[0][1]) // scale, min_size), max_run):
+                for key, offset, length in run:
+                    add(key, offset, length, restart)
+            else:
+                start, n = run[0][1], 0
+                for i, (key, offset, length) in enumerate(run):
+                    n += 1
+                    if offset + length - start >= min_size * scale or i == len(run) - 1:
+                        if n == 1:
+                            add(key, offset, length, restart)
+                        else:
+                            add(('group', (start, offset + length, n)), start, offset + length - start, restart)
+                        start, n = offset + length, 0
+            run.clear()
+
+        for item in self.tiff.addresses.get_assignments(start):
+            key, value = item[0]
+            if not (key[0].lower() == 'empty' and value[1] == 1):
+                if key[0].lower() == 'empty':
+                    key = ('empty', (value[0] + value[1] // 2,))
+                else:
+                    out = key in outside
+                    if len(item) > 1 or key in shared:
+                        key = (key[0].upper(),) + key[1:]
+                    if out:
+                        bar.outside.add(key)
+                if value[1] // scale < min_size:
+                    run.append((key, *value))
+                    if len(run) >= max_pending:
+                        flush()
+                else:
+                    flush()
+                    add(key, *value)
+        flush()
+        bar.file_len = len(self.tiff)
+        index = self.tiff.addresses.sort()
+        bar.rows = index.offsets, index.lengths, index.group, index.item
+        return bar
+
+    def zoom(self, scale, y):
+        """ Zooms to scale bytes per pixel, keeping the byte at y pixels in the bar in place """
+        addr = self.get_addr(y)
+        y -= self.parent.scrollArea.verticalScrollBar().value()
+        self.scale = min(max(int(scale), 1), max(len(self.tiff), 1))
+        self.relayout(addr, y)
+
+    def wheelEvent(self, event):
+        if self.tiff is not None and event.modifiers() & QtCore.Qt.ControlModifier:
+            self.zoom(self.scale / 2 ** (event.angleDelta().y() / 120), event.position().y())
+        else:
+            event.ignore()
+
+    def mousePressEvent(self, event):
+        if self.tiff is None:
+            return
+        (code, key), value = self.bar.get_assignment(event.localPos().y())[0]
+        if code == 'group':  # zoom in on the group so that it fills the viewport
+            self.scale = max((key[1] - key[0]) // self.parent.scrollArea.viewport().height(), 1)
+            self.relayout(key[0], 0)
+            return
+        with self.tiff.lock:
+            self.show_region(event.localPos().y())
+
+    def show_region(self, y):
+        ((code, key), *_), _ = zip(*self.bar.get_assignment(y))
+        if code.lower() == 'empty':
+            addr = key[0]
+        else:
+            addr = self.tiff.addresses[(code.lower(), key)]
+            addr = addr[0] + addr[1] // 2
+        keys, (addr, *_) = zip(*self.parent.tiff.addresses.get_assignment(addr))
+
+        text = [' '.join([f'{k}' for k in (c.lower(), *k)]) for c, *k in keys]
+        text.append('')
+        text.append(f'Adresses: {addr[0]} - {sum(addr)}')
+        text.append(f'Length: {addr[1]}')
+        if code.lower() == 'header':
+            text.append(f'\nFile size: {len(self.tiff)}')
+            text.append(f'Unused bytes in file: {self.tiff.get_empty()}')
+            overlaps = self.tiff.addresses.get_overlaps()
+            text.append(f'Identically shared regions: {len(overlaps["identical"])}')
+            text.append(f'Overlapping regions: {len(overlaps["overlaps"])}, of which partially: '
+                        f'{sum(overlap[-1] == "partial" for overlap in overlaps["overlaps"])}')
+            text.append(f'Regions beyond the end of the file: {len(overlaps["out_of_bounds"])}')
+            text.append(f'Byte order: {self.tiff.byteorder}')
+            text.append(f'Big tiff: {self.tiff.bigtiff}')
+            text.append(f'Tag size: {self.tiff.tagsize}')
+            text.append(f'Tag number format: {self.tiff.tagnoformat}')
+            text.append(f'Offset size: {self.tiff.offsetsize}')
+            text.append(f'Offset format: {self.tiff.offsetformat}')
+            text.append(f'First ifd offset: {self.tiff.offsets[(0,)]}')
+        if code.lower() in ('ifd', 'subifd'):
+            text.append(f'Number of tags: {self.tiff.nTags[key]}')
+            text.append(f'Unused bytes in ifd: {self.tiff.get_empty(key)}')
+            text.append(f'Next ifd offset: {self.tiff.offsets.get(key[:-1] + (key[-1] + 1,))}')
+            self.parent.tagmodel.set_tags(self.tiff.tags[key])
+        elif code.lower() == 'tagdata':
+            tags = self.tiff.tags[key[:-1]]
+            self.parent.tagmodel.set_tags(tags, [tags.find(key[-1])])
+        else:
+            self.parent.tagmodel.set_tags()
+        if code.lower() == 'image' and len(key) == 2:
+            self.parent.preview.request(self.tiff, key, (self.parent.image.height(), self.parent.image.width()))
+        else:
+            self.parent.preview.request()
+            self.parent.setImage()
+        self.parent.properties.setText('\n'.join(text))
+        self.parent.binary.select(*addr)
+
+
+class HexView(QtWidgets.QAbstractScrollArea):
+    """ Offset, hex and ascii view of the file, only the visible rows are read from the file. The selected region
+        is highlighted, as are the fields of the ifds: number of tags and next ifd offset, tag codes and types,
+        counts and values which are offsets to tag data.
+    """
+    rowsize = 16
+    color = {'selection': 'lightyellow', 'ifd': 'cyan', 'code': 'lightblue', 'count': 'lightgray',
+             'offset': 'orange'}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.tiff = None
+        self.selection = (0, 0)
+        self.top = 0  # the first row shown, rows of files over 32 GiB do not fit in the range of the scrollbar
+        self.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
+
+    def set_tiff(self, tiff):
+        self.tiff = tiff
+        self.selection = (0, 0)
+        self.top = 0
+        self.update_scrollbar()
+
+    def get_max_top(self):
+        rows = 0 if self.tiff is None else -(-len(self.tiff) // self.rowsize)
+        return max(rows - self.visible_rows(), 0)
+
+    def get_scale(self):
+        """ number of rows per step of the scrollbar """
+        return max(-(-self.get_max_top() // (2 ** 31 - 1)), 1)
+
+    def update_scrollbar(self):
+        scale = self.get_scale()
+        scrollbar = self.verticalScrollBar()
+        scrollbar.setPageStep(max(self.visible_rows() // scale, 1))
+        scrollbar.setRange(0, -(-self.get_max_top() // scale))
+        self.set_top(self.top)
+
+    def scrolled(self, value):
+        if value != self.top // self.get_scale():  # moved by the user, not by set_top
+            self.top = min(value * self.get_scale(), self.get_max_top())
+        self.viewport().update()
+
+    def set_top(self, top):
+        self.top = min(max(top, 0), self.get_max_top())
+        self.verticalScrollBar().setValue(self.top // self.get_scale())
+        self.viewport().update()
+
+    def visible_rows(self):
+        return max(self.viewport().height() // QtGui.QFontMetrics(self.font()).height(), 1)
+
+    def resizeEvent(self, event):
+        self.update_scrollbar()
+        super().resizeEvent(event)
+
+    def select(self, offset, length):
+        self.selection = (offset, length)
+        self.goto(offset)
+
+    def goto(self, offset):
+        """ Shows offset, which is clipped to the file """
+        self.set_top(min(max(offset, 0), max(len(self.tiff) - 1, 0) if self.tiff is not None else 0) // self.rowsize)
+
+    def get_colors(self, start, end):
+        """ Colors of the highlighted bytes between start and end """
+        colors = {}
+        offset, length = self.selection
+        for addr in range(max(start, offset), min(end, offset + length)):
+            colors[addr] = self.color['selection']
+        tiff = self.tiff
+        tagnosize = struct.calcsize(tiff.tagnoformat)
+        fields = ((0, 4, 'code'), (4, 4 + tiff.offsetsize, 'count'),
+                  (4 + tiff.offsetsize, 4 + 2 * tiff.offsetsize, 'value'))
+        with tiff.lock:
+            ifds = [(key[1], value) for item in tiff.addresses.get_assignments(start, end)
+                    for key, value in item if key[0] in ('ifd', 'subifd')]
+        for idx, (offset, length) in ifds:
+            if offset + length <= start:
+                continue
+            spans = [(offset, offset + tagnosize, 'ifd'), (offset + length - tiff.offsetsize, offset + length, 'ifd')]
+            for i, size in enumerate(tiff.tags[idx].sizes):
+                entry = offset + tagnosize + i * tiff.tagsize
+                for a, b, field in fields:
+                    if field == 'value':
+                        if size <= tiff.offsetsize:
+                            continue
+                        field = 'offset'
+                    spans.append((entry + a, entry + b, field))
+            for a, b, field in spans:
+                for addr in range(max(start, a), min(end, b)):
+                    colors[addr] = self.color[field]
+        return colors
+
+    def paintEvent(self, event):
+        qp = QtGui.QPainter(self.viewport())
+        if self.tiff is not None:
+            metrics = QtGui.QFontMetrics(self.font())
+            width, height = metrics.horizontalAdvance('0'), metrics.height()
+            start = self.top * self.rowsize
+            data = bytes(self.tiff.read(start, (self.visible_rows() + 1) * self.rowsize))
+            colors = self.get_colors(start, start + len(data))
+            for row in range(-(-len(data) // self.rowsize)):
+                y = row * height
+                line = data[row * self.rowsize:(row + 1) * self.rowsize]
+                for j, byte in enumerate(line):
+                    x_hex, x_ascii = (12 + 3 * j + (j >= 8)) * width, (13 + 3 * self.rowsize + j) * width
+                    color = colors.get(start + row * self.rowsize + j)
+                    if color is not None:
+                        qp.fillRect(x_hex, y, 2 * width, height, QtGui.QColor(color))
+                        qp.fillRect(x_ascii, y, width, height, QtGui.QColor(color))
+                    qp.drawText(x_hex, y + metrics.ascent(), f'{byte:02x}')
+                    qp.drawText(x_ascii, y + metrics.ascent(), chr(byte) if 32 <= byte < 127 else '.')
+                qp.drawText(0, y + metrics.ascent(), f'{start + row * self.rowsize:010x}')
+        qp.end()
+
+
+class TagModel(QtCore.QAbstractItemModel):
+    """ One row per tag, values are formatted only when their row is shown: the first preview values in the row of
+        the tag and, when it is expanded, pages of pagesize values as its child rows
+    """
+    columns = ('Code', 'Name', 'Type', 'Count', 'Address', 'Value')
+    preview = 16
+    pagesize = 256
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.set_tags()
+
+    def set_tags(self, tags=None, rows=None):
+        """ tags: tagtable, rows: the rows of its entries to show, default: all """
+        self.beginResetModel()
+        self.table = tags
+        self.tags = [] if tags is None else list(range(len(tags.entries))) if rows is None else rows
+        self.records = {}  # row: (code, tagrecord), the values of tags are decoded only when their row is shown
+        self.endResetModel()
+
+    def get_tag(self, row):
+        if row not in self.records:
+            self.records[row] = self.table.codes[self.tags[row]], self.table.record(self.tags[row])
+        return self.records[row]
+
+    def get_count(self, row):
+        """ the count in the entry of the tag, the number of values, the length of ascii values includes the NUL """
+        return int(self.table.entries['count'][self.tags[row]])
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column, parent.row() + 1 if parent.isValid() else 0)
+
+    def parent(self, index):
+        if not index.isValid() or index.internalId() == 0:
+            return QtCore.QModelIndex()
+        return self.createIndex(index.internalId() - 1, 0, 0)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self.tags)
+        if parent.internalId() == 0 and parent.column() == 0:
+            if self.get_tag(parent.row())[1].ttype not in tiffread.tiff.typesizes:  # the value is the raw entry
+                return 0
+            count = self.get_count(parent.row())
+            return -(-count // self.pagesize) if count > self.preview else 0
+        return 0
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.columns)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.columns[section]
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role not in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            return None
+        column = self.columns[index.column()]
+        if index.internalId():  # a page of values
+            code, tag = self.get_tag(index.internalId() - 1)
+            start = index.row() * self.pagesize
+            if column == 'Code':
+                return f'{start} - {min(start + self.pagesize, self.get_count(index.internalId() - 1)) - 1}'
+            if column == 'Value':
+                return tiffread.tiff.fmt_value(tag, start, start + self.pagesize)
+            return None
+        code, tag = self.get_tag(index.row())
+        if column == 'Code':
+            return str(code)
+        if column == 'Name':
+            return tifffile.TIFF.TAGS.get(code, '')
+        if column == 'Type':
+            try:
+                return f'{tag.ttype}; {tifffile.DATATYPE(tag.ttype).name.lower()}'
+            except ValueError:
+                return str(tag.ttype)
+        if column == 'Count':
+            return str(self.get_count(index.row()))
+        if column == 'Address':
+            return str(tag.address)
+        if self.get_count(index.row()) > self.preview:
+            return tiffread.tiff.fmt_value(tag, 0, self.preview) + ' ...'
+        return tiffread.tiff.fmt_value(tag)
+
+
+class Preview(QtCore.QObject):
+    """ Decodes image segments, computes their statistics and a downsampled preview in a worker thread, only the
+        result of the latest request is delivered, older requests are cancelled
+    """
+    ready = QtCore.pyqtSignal(int, object, object, object)
+    chunksize = 2 ** 16
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = ThreadPoolExecutor(1)
+        self.generation = 0
+        self.future = None
+
+    def request(self, tiff=None, key=None, shape=None):
+        """ Cancels any pending request and starts a new one if a tiff is given, returns the number of the request """
+        self.generation += 1
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        if tiff is not None:
+            self.future = self.pool.submit(self.run, self.generation, tiff, key, shape)
+        return self.generation
+
+    def stale(self, generation):
+        return generation != self.generation
+
+    def run(self, generation, tiff, key, shape):
+        try:
+            im = tiff.asarray(*key)
+            if im is None or self.stale(generation):
+                return
+            stats = self.get_stats(im, generation)
+            if stats is None:
+                return
+            preview = self.get_preview(im, shape, *stats[1:3])
+            if not self.stale(generation):
+                self.ready.emit(generation, im, stats, preview)
+        except Exception as e:
+            if not self.stale(generation):
+                self.ready.emit(generation, None, e, None)
+
+    def get_stats(self, im, generation=None):
+        """ Size, min, max, mean and std in one pass over the data, chunk by chunk, chunks are combined with
+            Chan's parallel variance algorithm; returns None when the request went stale
+        """
+        data = im.reshape(-1)
+        n, lo, hi, mean, m2 = 0, None, None, 0.0, 0.0
+        for i in range(0, data.size, self.chunksize):
+            if generation is not None and self.stale(generation):
+                return
+            chunk = data[i:i + self.chunksize]
+            c_lo, c_hi = chunk.min(), chunk.max()
+            lo = c_lo if lo is None else min(lo, c_lo)
+            hi = c_hi if hi is None else max(hi, c_hi)
+            c_mean = chunk.mean(dtype=float)
+            c_m2 = float(np.square(chunk - c_mean).sum())
+            delta, c_n = c_mean - mean, chunk.size
+            mean += delta * c_n / (n + c_n)
+            m2 += c_m2 + delta ** 2 * n * c_n / (n + c_n)
+            n += c_n
+        return n, lo, hi, mean, (m2 / n) ** 0.5 if n else 0.0
+
+    @staticmethod
+    def get_preview(im, shape, lo, hi):
+        """ Downsampled uint8 version of im which fits in shape (height, width): strided decimation takes out most
+            of the pixels, the block mean of the rest smooths the result, only then is it normalized
+        """
+        if im.ndim == 1:
+            im = im[None]
+        elif im.ndim == 3:
+            im = im.transpose(2, 0, 1).reshape((im.shape[0] * im.shape[2], im.shape[1]))
+        elif im.ndim > 3:
+            im = im.reshape((-1, im.shape[-1]))
+        f = max(-(-im.shape[0] // max(shape[0], 1)), -(-im.shape[1] // max(shape[1], 1)), 1)
+        if f > 1:
+            step = max(f // 4, 1)
+            block = -(-f // step)  # step * block >= f, so the result fits in shape
+            im = im[::step, ::step]
+            h, w = im.shape[0] // block, im.shape[1] // block
+            if h and w:
+                im = im[:h * block, :w * block].reshape((h, block, w, block)).mean((1, 3))
+            else:
+                im = im[::block, ::block]
+        if hi > lo:
+            im = (255 * ((im - lo) / (float(hi) - float(lo)))).clip(0, 255)
+        else:
+            im = np.zeros(im.shape)
+        return np.ascontiguousarray(im, 'uint8')
+
+    def close(self):
+        self.request()
+        self.pool.shutdown(wait=False)
+
+
+class App(QtWidgets.QMainWindow, UiMainWindow):
+    scanned = QtCore.pyqtSignal(object)
+
+    def __init__(self, tiff=None):
+        super().__init__()
+        self.tiff = None
+        self.setupUi(self)
+        self.scanned.connect(self.update_file)
+        self.preview = Preview(self)
+        self.preview.ready.connect(self.show_preview)
+        self.tagmodel = TagModel(self)
+        self.tagview.setModel(self.tagmodel)
+        self.bar = Bar(self)
+        self.leftcolumn.addWidget(self.bar)
+        self.legend = Legend(self)
+        self.middlecolumn.addWidget(self.legend)
+        self.actionOpen.triggered.connect(self.openDialog)
+        self.actionRepack.triggered.connect(self.repackDialog)
+        self.actionFollow.toggled.connect(self.follow)
+        self.goto.returnPressed.connect(self.gotoOffset)
+        self.open(tiff)
+        self.show()
+
+    def show_preview(self, generation, im, stats, preview):
+        """ Called (queued) from the preview worker """
+        if generation != self.preview.generation:
+            return
+        if im is None:
+            self.properties.append(f'\nCould not decode: {stats}')
+            self.setImage()
+            return
+        self.properties.append(f'\nStrip size: {im.shape}')
+        self.properties.append(f'Data type: {im.dtype}')
+        self.properties.append(f'Min, max: {stats[1]}, {stats[2]}')
+        self.properties.append(f'Mean, std: {stats[3]}, {stats[4]}')
+        self.setImage(preview)
+
+    def setImage(self, *args):
+        if len(args):
+            im = args[0]
+            shape = im.shape
+            im = QtGui.QImage(im.data, shape[1], shape[0], shape[1], QtGui.QImage.Format_Grayscale8)
+            f = max(int(min([a / b for a, b in zip((self.image.height(), self.image.width()), shape)])), 1)
+            pix = QtGui.QPixmap(im).scaled(f * shape[1], f * shape[0])
+        else:
+            pix = QtGui.QPixmap()
+        self.image.setPixmap(pix)
+
+    def openDialog(self):
+        file, _ = QtWidgets.QFileDialog.getOpenFileName(self,
+                    "Open config file", "", "TIFF Files (*.tif *.tiff);;DNG files (*.dng);;All Files (*)",
+                    options=(QtWidgets.QFileDialog.Options() | QtWidgets.QFileDialog.DontUseNativeDialog))
+        self.open(file)
+
+    def gotoOffset(self):
+        try:
+            self.binary.goto(int(self.goto.text(), 0))
+        except ValueError:
+            self.statusbar.showMessage(f'Not an offset: {self.goto.text()}')
+
+    def repackDialog(self):
+        if self.tiff is None:
+            return
+        if not self.tiff.done.is_set():
+            self.statusbar.showMessage('Wait until the file is scanned before repacking it')
+            return
+        file, _ = QtWidgets.QFileDialog.getSaveFileName(self,
+                    "Save repacked file", "", "TIFF Files (*.tif *.tiff);;All Files (*)",
+                    options=(QtWidgets.QFileDialog.Options() | QtWidgets.QFileDialog.DontUseNativeDialog))
+        if file:
+            reopen = isfile(file) and samefile(file, self.tiff.file)  # the open file is replaced by the repacked one
+            stats = self.tiff.repack(file)
+            if reopen:
+                self.open(file)
+            self.statusbar.showMessage('Repacked: ' + ', '.join(f'{key}: {stats["before"][key]} -> {stats["after"][key]}'
+                                                                for key in stats['before']))
+
+    def open(self, file):
+        if file is not None and isfile(file):
+            self.preview.request()
+            self.tagmodel.set_tags()
+            if self.tiff is not None:
+                self.tiff.close()
+            self.tiff = tiffread.tiff(file, lazy=True, callback=self.scanned.emit, cache=True, stats=True)
+            self.follow(self.actionFollow.isChecked())
+            self.bar.new_file()
+            self.binary.set_tiff(self.tiff)
+            self.setWindowTitle(f'TiffExp: {basename(self.tiff.file)}')
+
+    def follow(self, follow):
+        """ Follows the file while it is being written, new ifds are added to the bar when the file grows """
+        if self.tiff is not None:
+            if follow:
+                self.tiff.follow()
+            else:
+                self.tiff.unfollow()
+
+    def update_file(self, tiff):
+        """ Called (queued) from the thread scanning or following tiff """
+        if tiff is self.tiff:
+            self.bar.new_file()
+            self.binary.update_scrollbar()
+            if tiff.done.is_set():
+                self.statusbar.showMessage(f'{len(tiff.tags)} ifds; {tiff.stats}')
+            else:
+                self.statusbar.showMessage(f'Scanning: {len(tiff.tags)} ifds, {tiff.progress:.0%}')
+
+    def closeEvent(self, *args, **kwargs):
+        self.preview.close()
+        if self.tiff is not None:
+            self.tiff.close()
+
+
+def main():
+    app = QtWidgets.QApplication([])
+    w = App(argv[1]) if len(argv) > 1 else App()
+    exit(app.exec())
+
+
+if __name__ == '__main__':
+    main()
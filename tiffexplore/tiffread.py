@@ -1,220 +1,1274 @@
+import gc
+import mmap
+import os
 import struct
+import warnings
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from heapq import heappop, heappush
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from hashlib import sha1
+from os.path import abspath, expanduser, join
+from threading import Event, Lock, RLock, Thread, current_thread
+from time import perf_counter, time
 import tifffile
 import numpy as np
 from traceback import format_exc
 
 class tiff():
-    def __init__(self, file):
+    readahead = 32  # number of tags read speculatively together with the number of tags in an ifd
+    interval = 0.5  # minimal time in s between calls to callback while scanning
+    subifdcodes = (330, 400, 34665, 34853, 40965)  # tags pointing to chains of sub ifds
+    cachesize = 2 ** 28  # maximum number of bytes of decoded segments to keep
+    chunksize = 2 ** 20  # number of bytes read at once for strided slices when the file is not memory mapped
+    relocated = {273: 279, 324: 325, 513: 514}  # tags with offsets of image data: tags with their byte counts
+    unrelocated = (519, 520, 521)  # offsets of old style JPEG tables, of unknown length, which repack cannot move
+    dropped = (288, 289)  # FreeOffsets and FreeByteCounts, which are meaningless after repacking
+    typesizes = {ttype: struct.calcsize(dtype) for ttype, dtype in tifffile.TIFF.DATA_FORMATS.items()}
+
+    def __init__(self, file, memmap=True, lazy=False, callback=None, workers=8, cache=None, stats=False,
+                 strict=False):
+        """ lazy: read the header and first ifd, then scan the rest of the file in a background thread
+            callback: callback(self) is called from the scanning thread every interval s and when done
+            workers: number of threads reading chains of sub ifds concurrently, with os.pread instead of the memory map
+            cache: layoutcache to load the layout from or save it to, True: layoutcache in the default location
+            stats: count reads and time the phases of parsing in self.stats
+            strict: raise the error which stopped parsing instead of printing it, unless lazy
+        """
         self.file = file
+        self.stats = iostats(stats)
+        if stats:  # only instrument reads when asked, so that they cost nothing otherwise
+            self.read = self.counted_read
         self.fh = open(file, 'rb')
-        try:
-            self.tiff = tifffile.TiffFile(self.file)
-        except Exception:
-            self.tiff = None
+        self.fhlock = Lock()
+        self.memmap = memmap
+        self.mmap = None
+        self.map()
+        self._tiff = None  # tifffile.TiffFile, opened when an image is decoded, False if that fails
+        self.segments = segmentcache(self.cachesize)
         self.tags = {}
-        self.get_file_len()
         self.addresses = assignments(len(self))
         self.offsets = {}
         self.nTags = {}
         self.tagsread = set()
-        try:
-            self.read_ifd_offsets(self.read_header())
+        self.seen = set()  # offsets of the ifds read, a chain pointing to any of them is not followed further
+        self.unread = deque()  # ifds of which the tags still need to be read
+        self.lock = RLock()  # held by the scanning thread while it changes the structure
+        self.callback = callback
+        self.cancelled = Event()
+        self.done = Event()
+        self.error = None  # the exception which stopped parsing
+        self.thread = None
+        self.follower = None  # thread following the file while it is being written
+        self.following = Event()
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.cache = layoutcache() if cache is True else cache or None
+        scan = self.scan()
+        if lazy:
+            self.run(scan, 1)
+            self.thread = Thread(target=self.run, args=(scan,), daemon=True)
+            self.thread.start()
+        else:
+            self.run(scan, strict=strict)
+
+    def scan(self):
+        """ Generator reading the structure of the file, it yields after every ifd in the main chain """
+        with self.stats.phase('header'):
+            offset = self.read_header()
+        if self.cache is not None:
+            with self.stats.phase('cache'):
+                if self.load_layout():
+                    return
+        ifds = self.iter_ifd_offsets(offset)
+        while True:
+            with self.stats.phase('ifd chain'):
+                if next(ifds, None) is None:
+                    break
             self.read_tags()
-        except Exception:
+            yield
+        with self.stats.phase('indexing'):
+            self.addresses.sort()
+        if self.cache is not None:
+            with self.stats.phase('cache'):
+                self.cache.save(self)
+
+    def fingerprint(self):
+        """ Hash of the header and the start of the first ifd """
+        return sha1(bytes(self.read(0, 16)) + bytes(self.read(self.offset, 4096))).hexdigest()
+
+    def get_layout(self):
+        """ The layout in flat arrays, see layoutcache """
+        ifds, pack = list(self.tags), layoutcache.pack_keys
+        entries = [self.tags[idx].entries for idx in ifds]
+        names = sorted({key[0] for key in dict.keys(self.addresses)} | {key[0] for key in self.addresses.arrays})
+        number = {name: i for i, name in enumerate(names)}
+        arrays = list(self.addresses.arrays.items())
+        return {'ifds': pack(ifds), 'ntags': np.array([self.nTags[idx] for idx in ifds], 'int64'),
+                'entries': np.concatenate(entries) if entries else np.zeros(0, self.ifddtype),
+                'counts': np.array([len(e) for e in entries], 'int64'),
+                'offset_keys': pack(self.offsets), 'offset_values': np.array(list(self.offsets.values()), 'int64'),
+                'names': np.array(names, str),
+                'address_names': np.array([number[key[0]] for key in dict.keys(self.addresses)], 'int64'),
+                'address_keys': pack([key[1] for key in dict.keys(self.addresses)]),
+                'address_values': np.array(list(dict.values(self.addresses)), 'int64').reshape((-1, 2)),
+                'array_names': np.array([number[key[0]] for key, _ in arrays], 'int64'),
+                'array_keys': pack([key[1] for key, _ in arrays]),
+                'array_counts': np.array([len(offsets) for _, (offsets, _) in arrays], 'int64'),
+                'array_offsets': np.concatenate([offsets for _, (offsets, _) in arrays] or [np.zeros(0, 'int64')]),
+                'array_lengths': np.concatenate([lengths for _, (_, lengths) in arrays] or [np.zeros(0, 'int64')])}
+
+    def load_layout(self):
+        layout = self.cache.load(self)
+        if layout is None:
+            return False
+        enabled = gc.isenabled()
+        gc.disable()  # the garbage collector makes making many small objects at once much slower
+        try:
+            self.set_layout(layout)
+        finally:
+            if enabled:
+                gc.enable()
+        return True
+
+    def set_layout(self, layout):
+        unpack, names = layoutcache.unpack_keys, layout['names'].tolist()
+        ifds = unpack(layout['ifds'])
+        self.offsets = dict(zip(unpack(layout['offset_keys']), layout['offset_values'].tolist()))
+        self.nTags = dict(zip(ifds, layout['ntags'].tolist()))
+        entries, counts = layout['entries'], layout['counts'].tolist()
+        self.tags = {idx: tagtable(self, self.offsets[idx], entries[end - n:end])
+                     for idx, n, end in zip(ifds, counts, np.cumsum(counts, dtype='int64').tolist())}
+        keys = zip([names[i] for i in layout['address_names'].tolist()], unpack(layout['address_keys']))
+        self.addresses = assignments(len(self), zip(keys, map(tuple, layout['address_values'].tolist())))
+        keys = zip([names[i] for i in layout['array_names'].tolist()], unpack(layout['array_keys']))
+        counts = layout['array_counts'].tolist()
+        self.addresses.arrays = {key: (layout['array_offsets'][end - n:end], layout['array_lengths'][end - n:end])
+                                 for key, n, end in zip(keys, counts, np.cumsum(counts, dtype='int64').tolist())}
+        self.tagsread = set(self.tags)
+        self.seen = {self.offsets[idx] for idx in self.nTags}
+
+    def run(self, scan, n=None, strict=False):
+        """ Runs scan for n steps or until it is finished or cancelled, strict: raise errors instead of printing """
+        last = time()
+        try:
+            while n is None or n > 0:
+                if self.cancelled.is_set():
+                    return
+                with self.lock:
+                    next(scan)
+                if n is not None:
+                    n -= 1
+                if self.callback is not None and time() - last > self.interval:
+                    self.callback(self)
+                    last = time()
+            return
+        except StopIteration:
+            pass
+        except Exception as error:
+            self.error = error
+            if strict:
+                self.close()
+                raise
             print(format_exc())
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
 
-    def read_ifd_offsets(self, offset, ifdtype=tuple()):
-        idx = 0
-        self.offsets[ifdtype + (idx,)] = offset
-        while 0 < self.offsets[ifdtype + (idx,)] < len(self):
-            self.offsets[ifdtype + (idx + 1,)] = self.read_ifd(ifdtype + (idx,))
+    def cancel(self):
+        """ Stops scanning and following the file in the background """
+        self.cancelled.set()
+        self.unfollow()
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join()
+
+    def follow(self, interval=1):
+        """ Follows a file which is still being written: every interval s update is called in a background thread,
+            after scanning is done, callback(self) is called when the layout changed
+        """
+        if self.follower is None:
+            self.following.set()
+            self.follower = Thread(target=self.run_follow, args=(interval,), daemon=True)
+            self.follower.start()
+
+    def unfollow(self):
+        self.following.clear()
+        if self.follower is not None and self.follower is not current_thread():
+            self.follower.join()
+        self.follower = None
+
+    def run_follow(self, interval):
+        while self.following.is_set() and not self.cancelled.wait(interval):
+            if not self.done.is_set():
+                continue
+            try:
+                changed = self.update()
+            except Exception:  # most likely an ifd which is still being written, it is read again next time
+                changed = None
+            if changed is not None and self.callback is not None:
+                self.callback(self)
+
+    def update(self):
+        """ Reads the ifds added to the file since it was scanned: the last ifd in the main chain is read again, in
+            case its next ifd offset was patched in, and the chain is followed from there. Only works after scanning.
+            Returns the lowest address at which the layout changed, None if it did not change.
+        """
+        with self.lock, self.stats.phase('update'):
+            size = os.fstat(self.fh.fileno()).st_size
+            last = self.get_last_ifd()
+            if last is None:  # no ifds yet
+                if size == len(self) and size >= 8 and self.offsets.get((0,)) == self.read_header():
+                    return None
+                changed, last = 0, 0
+            else:
+                last, offset = last
+                length = self.addresses.get(('ifd', (last,)), (offset, 0))[1]
+                pointer = self.read(offset + length - self.offsetsize, self.offsetsize) if length else b''
+                if size == len(self) and len(pointer) == self.offsetsize and self.offsets.get((last + 1,)) == \
+                        struct.unpack(self.byteorder + self.offsetformat, pointer)[0]:
+                    return None
+                changed = min(offset, len(self))
+            if size != len(self):
+                self.map()
+            offset = self.read_header() if last == 0 and (0,) not in self.nTags else self.offsets[(last,)]
+            self.tagsread.discard((last,))
+            self.seen.discard(offset)
+            for _ in self.iter_ifd_offsets(offset, start=last):
+                pass
+            self.read_tags()
+            if self._tiff:  # tifffile does not know about the new pages
+                self._tiff.close()
+            self._tiff = None
+            return changed
+
+    def get_last_ifd(self):
+        """ (number, offset) of the last ifd in the main chain, None if there are none """
+        last = max((idx[0] for idx in self.nTags if len(idx) == 1), default=None)
+        return None if last is None else (last, self.offsets[(last,)])
+
+    @property
+    def progress(self):
+        """ Estimate of the fraction of the file scanned """
+        if self.done.is_set():
+            return 1
+        with self.lock:
+            return min(max(self.offsets.values(), default=0) / max(len(self), 1), 1)
+
+    def read_ifd_offsets(self, offset, ifdtype=tuple(), store=None, start=0):
+        for _ in self.iter_ifd_offsets(offset, ifdtype, store, start):
+            pass
+
+    def iter_ifd_offsets(self, offset, ifdtype=tuple(), store=None, start=0):
+        """ Reads the chain of ifds starting at offset, the first ifd being number start in the chain, the chain ends
+            at an offset outside the file or at an ifd which was read already, which would otherwise be a loop
+        """
+        store = store or self
+        idx = start
+        store.offsets[ifdtype + (idx,)] = offset
+        while 0 < store.offsets[ifdtype + (idx,)] < len(self):
+            if store.offsets[ifdtype + (idx,)] in store.seen or store.offsets[ifdtype + (idx,)] in self.seen:
+                break
+            store.seen.add(store.offsets[ifdtype + (idx,)])
+            store.offsets[ifdtype + (idx + 1,)] = self.read_ifd(ifdtype + (idx,), store)
             idx += 1
+            yield ifdtype + (idx - 1,)
+
+    def read_chain(self, offset, ifdtype):
+        """ Reads a chain of sub ifds into a separate store, so that chains can be read concurrently """
+        chain = ifdchain()
+        try:
+            self.read_ifd_offsets(offset, ifdtype, chain)
+        except Exception:
+            print(format_exc())
+        return chain
 
     def read_tags(self):
-        while len(set(self.tags.keys()) - self.tagsread):
-            for idx in set(self.tags.keys()) - self.tagsread:
-                tags = self.tags[idx]
-                if idx not in self.tagsread:
-                    if 273 in tags and 279 in tags:
-                        for i, a in enumerate(zip(tags[273][-1], tags[279][-1])):
-                            self.addresses[('image', (*idx, i))] = a
-                    elif 324 in tags and 325 in tags:
-                        for i, a in enumerate(zip(tags[324][-1], tags[325][-1])):
-                            self.addresses[('image', (*idx, i))] = a
-                    for code in (330, 400, 34665, 34853, 40965):
-                        if code in tags:
-                            if len(tags[code][3]) == 1:
-                                self.read_ifd_offsets(tags[code][3][0], (*idx, code))
-                            else:
-                                for i, offset in enumerate(tags[code][3]):
-                                    self.read_ifd_offsets(tags[code][3][0], (*idx, code, i))
-                self.tagsread.add(idx)
+        """ Adds the images of all unread ifds and reads the chains of sub ifds they point to, the chains found
+            in one round are read concurrently and merged in the order in which they were found
+        """
+        while self.unread:
+            chains = []
+            with self.stats.phase('indexing'):
+                while self.unread:
+                    idx = self.unread.popleft()
+                    tags = self.tags[idx]
+                    if idx not in self.tagsread:
+                        for code, lengths in self.relocated.items():
+                            if code in tags and lengths in tags:
+                                self.addresses.add_array(('image', idx), tags[code].value, tags[lengths].value)
+                                break
+                        for code in self.subifdcodes:
+                            if code in tags:
+                                offsets = np.asarray(tags[code].value).tolist()
+                                if len(offsets) == 1:
+                                    chains.append((offsets[0], (*idx, code)))
+                                else:
+                                    for i, offset in enumerate(offsets):
+                                        chains.append((offset, (*idx, code, i)))
+                    self.tagsread.add(idx)
+            if not chains:
+                continue
+            with self.stats.phase('sub ifds'):
+                if self.pool is not None and len(chains) > 1:  # all are read before merging any, which changes seen
+                    chains = list(self.pool.map(self.read_chain, *zip(*chains)))
+                else:
+                    chains = [self.read_chain(*chain) for chain in chains]
+                for chain in chains:
+                    self.merge(chain)
+
+    def merge(self, chain):
+        """ Adds a chain of sub ifds, which ends at the first ifd read already, also by a chain merged before it """
+        chain.cut(self.seen)
+        self.offsets.update(chain.offsets)
+        self.nTags.update(chain.nTags)
+        self.tags.update(chain.tags)
+        self.seen.update(chain.seen)
+        self.addresses.update(chain.addresses)
+        self.unread.extend(chain.unread)
 
     @staticmethod
-    def fmt_tag(code, value):
+    def fmt_tag(code, tag):
         text = [f'Code: {code}']
         if code in tifffile.TIFF.TAGS:
             text[-1] += f'; {tifffile.TIFF.TAGS[code]}'
-        text.append(f'data format: {value[0]}')
+        text.append(f'data format: {tag.ttype}')
         try:
-            text[-1] += f'; {tifffile.TIFF.DATATYPES(value[0]).name.lower()}'
+            text[-1] += f'; {tifffile.DATATYPE(tag.ttype).name.lower()}'
         except ValueError:
             pass
-        text.append(f'address: {value[1]}')
-        text.append(f'count: {value[2]}')
-        if value[0] in (5, 10):
-            text.append(f'value: [{", ".join(["-" * (sum([w<0 for w in v]) % 2) + "/".join([str(abs(w)) for w in v[::-1]]) for v in value[3]])}]')
+        text.append(f'address: {tag.address}')
+        text.append(f'count: {tag.size}')
+        if tag.ttype in (5, 10):
+            text.append(f'value: [{tiff.fmt_value(tag)}]')
         else:
-            text.append(f'value: {value[3]}')
+            text.append(f'value: {tag.value}')
         return '\n'.join(text)
 
+    @staticmethod
+    def fmt_value(tag, start=0, stop=None):
+        """ Text of the values start to stop of a tag, only those values are formatted """
+        value = tag.value[start:stop]
+        if isinstance(value, (str, bytes)):
+            return str(value)
+        if tag.ttype in (5, 10):
+            return ', '.join(['-' * (sum([w < 0 for w in v]) % 2) + '/'.join([str(abs(w)) for w in v[::-1]])
+                              for v in value.tolist()])
+        return ', '.join(map(str, np.ravel(value).tolist()))
+
     def get_file_len(self):
         self.fh.seek(0, 2)
         self.len = self.fh.tell()
 
+    def map(self):
+        """ (Re)maps the file into memory if memmap and sets its length, a previous mapping is closed when the views
+            handed out from it are gone
+        """
+        if self.memmap:
+            try:
+                self.mmap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mmap)
+            except (ValueError, OSError):  # empty files, pipes, etc.
+                self.mmap = None
+        self.get_file_len()
+        if hasattr(self, 'addresses'):
+            self.addresses.max_addr = len(self)
+            self.addresses.version += 1
+
+    def read(self, offset, length, mapped=True):
+        """ Returns a zero copy memoryview into the file if it is memory mapped and mapped, otherwise reads bytes.
+            Page faults in the memory map are taken while holding the gil, but os.pread releases it while waiting for
+            the disk, so threads reading concurrently read with mapped=False.
+        """
+        if mapped and self.mmap is not None:
+            return self.view[offset:offset + length]
+        if hasattr(os, 'pread'):  # positional reads are safe to do from several threads
+            return os.pread(self.fh.fileno(), length, offset)
+        with self.fhlock:
+            self.fh.seek(offset)
+            return self.fh.read(length)
+
+    def counted_read(self, offset, length, mapped=True):
+        data = tiff.read(self, offset, length, mapped)
+        self.stats.count(offset, len(data))
+        return data
+
     def __len__(self):
         return self.len
 
+    @property
+    def tiff(self):
+        if self._tiff is None:
+            try:
+                self._tiff = tifffile.TiffFile(self.file)
+            except Exception:
+                self._tiff = False
+        return self._tiff or None
+
     def asarray(self, page, segment):
-        if self.tiff is not None:
-            return [d for d in zip(self.tiff.pages[page].segments(), range(segment + 1))][-1][0][0].squeeze()
+        """ Decodes only the requested strip or tile of a page, decoded segments are cached """
+        im = self.segments.get((page, segment))
+        if im is None and self.tiff is not None:
+            keyframe = self.tiff.pages[page].keyframe
+            offset, length = self.addresses[('image', (page, segment))]
+            kwargs = {'_fullsize': keyframe.is_tiled}
+            if keyframe.compression in (6, 7, 34892, 33007):  # JPEG
+                kwargs['jpegtables'] = self.tiff.pages[page].jpegtables
+                kwargs['jpegheader'] = keyframe.jpegheader
+            im = keyframe.decode(bytes(self.read(offset, length)) if length else None, segment, **kwargs)[0]
+            if im is not None:
+                im = im.squeeze()
+                im.flags.writeable = False  # the cached array is shared
+                self.segments[(page, segment)] = im
+        return im
 
     def read_header(self):
-        self.fh.seek(0)
-        self.byteorder = {b'II': '<', b'MM': '>'}[self.fh.read(2)]
-        self.bigtiff = {42: False, 43: True}[struct.unpack(self.byteorder + 'H', self.fh.read(2))[0]]
+        header = bytes(self.read(0, 8))
+        if header[:2] not in (b'II', b'MM'):
+            raise ValueError('Not a TIFF-file')
+        self.byteorder = {b'II': '<', b'MM': '>'}[header[:2]]
+        self.bigtiff = {42: False, 43: True}[struct.unpack(self.byteorder + 'H', header[2:4])[0]]
         if self.bigtiff:
             self.tagsize = 20
             self.tagnoformat = 'Q'
-            self.offsetsize = struct.unpack(self.byteorder + 'H', self.fh.read(2))[0]
+            self.offsetsize = struct.unpack(self.byteorder + 'H', header[4:6])[0]
             self.offsetformat = {8: 'Q', 16: '2Q'}[self.offsetsize]
-            assert struct.unpack(self.byteorder + 'H', self.fh.read(2))[0] == 0, 'Not a TIFF-file'
-            self.offset = struct.unpack(self.byteorder + self.offsetformat, self.fh.read(self.offsetsize))[0]
+            assert struct.unpack(self.byteorder + 'H', header[6:8])[0] == 0, 'Not a TIFF-file'
+            self.offset = struct.unpack(self.byteorder + self.offsetformat, self.read(8, self.offsetsize))[0]
         else:
             self.tagsize = 12
             self.tagnoformat = 'H'
             self.offsetformat = 'I'
             self.offsetsize = 4
-            self.offset = struct.unpack(self.byteorder + self.offsetformat, self.fh.read(self.offsetsize))[0]
+            self.offset = struct.unpack(self.byteorder + self.offsetformat, header[4:8])[0]
+        self.ifddtype = np.dtype([('code', self.byteorder + 'H'), ('ttype', self.byteorder + 'H'),
+                                  ('count', self.byteorder + self.offsetformat), ('value', f'V{self.offsetsize}')])
         self.addresses[('header', (0,))] = (0, 4 + self.bigtiff * 4 + self.offsetsize)
         return self.offset
 
-    def read_ifd(self, idx):
-        """ Reads an IFD of the tiff file
+    def read_ifd(self, idx, store=None):
+        """ Reads an IFD of the tiff file, the tag table is read at once and kept as a structured array, the values
+            of the tags are decoded when they are looked up
+            store: object with offsets, nTags, tags, unread and addresses to store the ifd in, default: self
             wp@tl20200214
         """
-        offset = self.offsets[idx]
-        self.fh.seek(offset)
-        nTags = struct.unpack(self.byteorder + self.tagnoformat, self.fh.read(struct.calcsize(self.tagnoformat)))[0]
-        self.nTags[idx] = nTags
-        self.tags[idx] = {}
+        store = store or self
+        mapped = store is self or self.pool is None  # chains of sub ifds are read concurrently by the pool
+        offset = store.offsets[idx]
+        tagnosize = struct.calcsize(self.tagnoformat)
+        data = self.read(offset, tagnosize + self.readahead * self.tagsize + self.offsetsize, mapped)
+        nTags = struct.unpack(self.byteorder + self.tagnoformat, data[:tagnosize])[0]
+        store.nTags[idx] = nTags
+        store.tags[idx] = tagtable(self, offset, np.zeros(0, self.ifddtype))
+        store.unread.append(idx)
         assert nTags < 4096, 'Too many tags'
 
-        length = 8 if self.bigtiff else 2
-        length += nTags * self.tagsize + self.offsetsize
-
-        for i in range(nTags):
-            code, ttype, caddr, dtypelen, count, value = 0, 0, 0, 0, 0, [0]
-            try:
-                self.fh.seek(offset + struct.calcsize(self.tagnoformat) + self.tagsize * i)
-
-                code, ttype = struct.unpack(self.byteorder + 'HH', self.fh.read(4))
-                count = struct.unpack(self.byteorder + self.offsetformat, self.fh.read(self.offsetsize))[0]
-                dtype = tifffile.TIFF.DATA_FORMATS[ttype]
-                dtypelen = struct.calcsize(dtype)
-
-                toolong = struct.calcsize(dtype) * count > self.offsetsize
-                if toolong:
-                    caddr = struct.unpack(self.byteorder + self.offsetformat, self.fh.read(self.offsetsize))[0]
-                    self.addresses[('tagdata', (*idx, code))] = (caddr, dtypelen * count)
-                    cp = self.fh.tell()
-                    self.fh.seek(caddr)
-                else:
-                    caddr = self.fh.tell()
-
-                if ttype == 1:
-                    value = self.fh.read(count)
-                elif ttype == 2:
-                    value = self.fh.read(count).decode('ascii').rstrip('\x00')
-                elif ttype in (5, 10):
-                    value = [struct.unpack(self.byteorder + dtype, self.fh.read(dtypelen)) for _ in range(count)]
-                else:
-                    value = [struct.unpack(self.byteorder + dtype, self.fh.read(dtypelen))[0] for _ in range(count)]
-
-                if toolong:
-                    self.fh.seek(cp)
-            except Exception:
-                print(format_exc())
-            self.tags[idx][code] = (ttype, caddr, dtypelen*count, value)
+        length = tagnosize + nTags * self.tagsize + self.offsetsize
+        if len(data) < length:
+            data = self.read(offset, length, mapped)
+        entries = np.frombuffer(data, self.ifddtype, nTags, tagnosize).copy()  # a copy, not a view into the file
+        codes, ttypes, counts = entries['code'].tolist(), entries['ttype'].tolist(), entries['count'].tolist()
+        for i, (code, ttype, count) in enumerate(zip(codes, ttypes, counts)):
+            size = self.typesizes.get(ttype, 0) * count
+            if size > self.offsetsize:
+                caddr = struct.unpack_from(self.byteorder + self.offsetformat, data,
+                                           tagnosize + self.tagsize * i + 4 + self.offsetsize)[0]
+                store.addresses[('tagdata', (*idx, code))] = (caddr, size)
+        store.tags[idx] = tagtable(self, offset, entries)
 
-        self.fh.seek(offset + struct.calcsize(self.tagnoformat) + self.tagsize * nTags)
-        nifd = struct.unpack(self.byteorder + self.offsetformat, self.fh.read(self.offsetsize))[0]
-        self.addresses[('sub' * (len(idx) > 1) + 'ifd', idx)] = (offset, 2 * struct.calcsize(self.tagnoformat)
-                                                                 + nTags * self.tagsize)
+        nifd = struct.unpack(self.byteorder + self.offsetformat, data[length - self.offsetsize:length])[0]
+        store.addresses[('sub' * (len(idx) > 1) + 'ifd', idx)] = (offset, length)
         return nifd
 
+    def decode_tag(self, ttype, dtype, count, data):
+        """ Decodes the value of a tag from its bytes, numeric values become arrays in native byte order, rationals
+            have shape (count, 2)
+        """
+        if ttype == 1:
+            return bytes(data[:count])
+        elif ttype == 2:
+            return bytes(data[:count]).decode('ascii').rstrip('\x00')
+        value = np.frombuffer(data, self.byteorder + dtype[-1], count * int(dtype[:-1]))
+        value = value.astype(value.dtype.newbyteorder('='))  # a copy, not a view into the file
+        if ttype in (5, 10):
+            return value.reshape((count, 2))
+        return value
+
     def get_empty(self, ifd=None):
         empty = 0
         if ifd is None:
-            for ((code, *key), value), *_ in self.addresses.get_assignments():
-                if code == 'empty':
-                    empty += value[-1]
-                elif code in ('ifd', 'subifd'):
-                    empty += self.get_empty(key[0])
+            with self.stats.phase('empty'):
+                for ((code, *key), value), *_ in self.addresses.get_assignments():
+                    if code == 'empty':
+                        empty += value[-1]
+                    elif code in ('ifd', 'subifd'):
+                        empty += self.get_empty(key[0])
         else:
-            empty = sum([self.offsetsize - v[2] if v[2] < self.offsetsize else 0 for v in self.tags[ifd].values()])
+            empty = sum([self.offsetsize - size for size in self.tags[ifd].sizes if size < self.offsetsize])
         return empty
 
+    def iter_ifds(self, idx=(0,)):
+        """ Yields the keys of the ifds in the chain starting at idx, each followed by its chains of sub ifds """
+        while idx in self.tags:
+            yield idx
+            tags = self.tags[idx]
+            for code in self.subifdcodes:
+                if code in tags:
+                    if len(tags[code].value) == 1:
+                        yield from self.iter_ifds((*idx, code, 0))
+                    else:
+                        for i in range(len(tags[code].value)):
+                            yield from self.iter_ifds((*idx, code, i, 0))
+            idx = idx[:-1] + (idx[-1] + 1,)
+
+    def get_fragmentation(self):
+        """ Statistics on how scattered the file is: the number of unused bytes and gaps, and the number of jumps
+            needed to read every ifd followed by its tag data and images, ignoring jumps over less than 8 bytes
+        """
+        with self.lock:
+            gaps = sum(item[0][0][0] == 'empty' for item in self.addresses.get_assignments())
+            jumps, end = 0, None
+            for idx in self.iter_ifds():
+                keys = [('sub' * (len(idx) > 1) + 'ifd', idx)] + [('tagdata', (*idx, code)) for code in self.tags[idx]]
+                regions = [self.addresses[key] for key in keys if key in self.addresses]
+                if ('image', idx) in self.addresses.arrays:
+                    regions.extend(zip(*(a.tolist() for a in self.addresses.arrays[('image', idx)])))
+                for offset, length in regions:
+                    jumps += end is None or not 0 <= offset - end < 8
+                    end = offset + length
+            return {'size': len(self), 'unused_bytes': self.get_empty(), 'gaps': gaps, 'jumps': jumps}
+
+    def get_repack_value(self, idx, code, ifds, data):
+        """ New type and value of a tag pointing to image data or sub ifds, given the new positions of ifds and data
+            by their original offsets
+        """
+        tags = self.tags[idx]
+        ttype, value = tags[code].ttype, tags[code].value.tolist()
+        if code in self.relocated:
+            lengths = tags[self.relocated[code]].value.tolist() if self.relocated[code] in tags else []
+            value = [data.get((offset, length), 0) for offset, length in zip(value, lengths)]
+            ttype = 4 if ttype == 3 else ttype  # SHORT offsets would likely overflow
+        else:
+            value = [ifds.get(offset, 0) for offset in value]
+        return ttype, value
+
+    def encode_repack_value(self, ttype, value):
+        dtype = np.dtype(self.byteorder + tifffile.TIFF.DATA_FORMATS[ttype][-1])
+        if value and max(value) > np.iinfo(dtype).max:
+            raise ValueError(f'offset {max(value)} does not fit in tag type {ttype}')
+        return np.array(value, dtype).tobytes()
+
+    def repack(self, file, chunksize=2 ** 20):
+        """ Writes a copy of the tiff to file without unused space. Every ifd is followed by its tag data, its image
+            data (strips, tiles or an old style JPEG stream) and its chains of sub ifds, all offsets are rewritten,
+            except those of old style JPEG tables, which are not copied, with a warning. Ifds and data shared between
+            ifds are written once, image data is copied in chunks of at most chunksize bytes. The entries of the ifds
+            are copied as they are, repeated codes included, except FreeOffsets and FreeByteCounts, only the offsets
+            in them are changed. Entries of unknown types are copied with a warning, as any offset in them cannot be
+            changed. The copy is written to a temporary file next to file, which then replaces file, so file can be
+            the tiff itself.
+            Returns the fragmentation of the file before and after repacking.
+        """
+        with self.lock:
+            align = 8 if self.bigtiff else 2  # of ifds and tag data, image data is not aligned
+            tagnosize = struct.calcsize(self.tagnoformat)
+            ops = []  # (position, kind, *args) in order of position
+            ifds, data = {}, {}  # original offset: new position of ifds, original (offset, length): new position
+            pos = 16 if self.bigtiff else 8
+
+            def place(size, align=align):
+                nonlocal pos
+                pos += -pos % align
+                start, pos = pos, pos + size
+                return start
+
+            for idx in self.iter_ifds():
+                if self.offsets[idx] in ifds:
+                    continue
+                table = self.tags[idx]
+                codes, ttypes, sizes = table.codes, table.entries['ttype'].tolist(), table.sizes
+                rows = sorted([row for row, code in enumerate(codes) if code not in self.dropped],
+                              key=codes.__getitem__)  # stable, so repeated codes keep their order
+                ifds[self.offsets[idx]] = place(tagnosize + len(rows) * self.tagsize + self.offsetsize)
+                pointers = {}  # row: new position of out of line tag data
+                ops.append((ifds[self.offsets[idx]], 'ifd', idx, rows, pointers))
+                for row in rows:
+                    code, ttype, size = codes[row], ttypes[row], sizes[row]
+                    if code in self.unrelocated:
+                        warnings.warn(f'tag {code} in ifd {idx} has offsets of JPEG tables, which are not copied, the '
+                                      'offsets are not rewritten')
+                    if ttype not in self.typesizes:
+                        warnings.warn(f'tag {code} in ifd {idx} has unknown type {ttype}, its entry is copied as is, '
+                                      'an offset in it is not rewritten')
+                    elif code in self.relocated or code in self.subifdcodes:
+                        ttype, value = self.get_repack_value(idx, code, ifds, data)
+                        size = len(value) * self.typesizes[ttype]
+                        if size > self.offsetsize:
+                            pointers[row] = place(size)
+                            ops.append((pointers[row], 'tag', idx, code))
+                    elif size > self.offsetsize:
+                        caddr = struct.unpack(self.byteorder + self.offsetformat,
+                                              bytes(table.entries[row]['value']))[0]
+                        if (caddr, size) not in data:
+                            data[(caddr, size)] = place(size)
+                            ops.append((data[(caddr, size)], 'copy', caddr, size))
+                        pointers[row] = data[(caddr, size)]
+                for code, lengths in self.relocated.items():
+                    if code in table and lengths in table:
+                        for segment in zip(table[code].value.tolist(), table[lengths].value.tolist()):
+                            if segment[1] and segment not in data:
+                                data[segment] = place(segment[1], 1)
+                                ops.append((data[segment], 'copy', *segment))
+
+            tmp = f'{file}.{os.getpid()}.tmp'  # file may be this tiff, which is read while writing
+            try:
+                with open(tmp, 'wb') as fh:
+                    if self.bigtiff:
+                        fh.write(struct.pack(self.byteorder + '2sHHHQ', b'II' if self.byteorder == '<' else b'MM', 43,
+                                             8, 0, ifds.get(self.offsets[(0,)], 0)))
+                    else:
+                        fh.write(struct.pack(self.byteorder + '2sHI', b'II' if self.byteorder == '<' else b'MM', 42,
+                                             ifds.get(self.offsets[(0,)], 0)))
+                    for position, kind, *args in ops:
+                        fh.write(bytes(position - fh.tell()))
+                        if kind == 'copy':
+                            offset, length = args
+                            for start in range(offset, offset + length, chunksize):
+                                chunk = self.read(start, min(chunksize, offset + length - start))
+                                fh.write(chunk)
+                                fh.write(bytes(min(chunksize, offset + length - start) - len(chunk)))
+                        elif kind == 'tag':
+                            fh.write(self.encode_repack_value(*self.get_repack_value(*args, ifds, data)))
+                        else:
+                            fh.write(self.encode_repack_ifd(*args, ifds, data))
+                os.replace(tmp, file)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        with tiff(file, workers=1) as repacked:
+            return {'before': self.get_fragmentation(), 'after': repacked.get_fragmentation()}
+
+    def encode_repack_ifd(self, idx, rows, pointers, ifds, data):
+        """ The entries in rows of the ifd as read from the file, with only the offsets of image data, sub ifds and
+            out of line tag data rewritten
+        """
+        entries = self.tags[idx].entries[rows]
+        for entry, row in zip(entries, rows):
+            code = int(entry['code'])
+            if (code in self.relocated or code in self.subifdcodes) and int(entry['ttype']) in self.typesizes:
+                ttype, value = self.get_repack_value(idx, code, ifds, data)
+                entry['ttype'], entry['count'] = ttype, len(value)
+                entry['value'] = self.encode_repack_value(ttype, value)[:self.offsetsize].ljust(self.offsetsize, b'\0')
+            if row in pointers:
+                entry['value'] = struct.pack(self.byteorder + self.offsetformat, pointers[row])
+        next_idx = idx[:-1] + (idx[-1] + 1,)
+        next_ifd = ifds.get(self.offsets[next_idx], 0) if next_idx in self.tags else 0
+        return struct.pack(self.byteorder + self.tagnoformat, len(rows)) + entries.tobytes() + \
+            struct.pack(self.byteorder + self.offsetformat, next_ifd)
+
     def __getitem__(self, item):
         if not isinstance(item, slice):
             item = slice(item, item+1)
         start = 0 if item.start is None or item.start < 0 else item.start
         step = item.step or 1
         stop = len(self) if item.stop is None or item.stop > len(self) else item.stop
-        self.fh.seek(start)
-        return self.fh.read(stop - start)[::step]
+        if self.mmap is not None:
+            return self.view[start:stop:step]
+        if step == 1:
+            return bytes(self.read(start, max(stop - start, 0)))
+        if step >= self.chunksize:  # far apart: read only the bytes needed
+            return b''.join([bytes(self.read(pos, 1)) for pos in range(start, stop, step)])
+        size = self.chunksize - self.chunksize % step  # chunks of a multiple of step bytes can be strided separately
+        return b''.join([bytes(self.read(pos, min(size, stop - pos)))[::step] for pos in range(start, stop, size)])
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        self.tiff.close()
         self.close()
 
     def close(self):
+        self.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self._tiff:
+            self._tiff.close()
+        self.segments.clear()
+        if self.mmap is not None:
+            try:
+                self.view.release()
+                self.mmap.close()
+            except BufferError:  # views handed out are still alive, the mapping is closed when they are gone
+                pass
         self.fh.close()
 
     def get_bytes(self, part):
-        offset, length = self.addresses[part]
-        self.fh.seek(offset)
-        return self.fh.read(length)
+        return self.read(*self.addresses[part])
+
+    def get_array(self, part, dtype='uint8'):
+        """ Returns a numpy array of the bytes in part of the file, a view when the file is memory mapped """
+        return np.frombuffer(self.get_bytes(part), dtype)
+
+
+class iostats():
+    """ Number of reads, of reads not continuing where the previous one ended (seeks), of bytes read, and the wall
+        time spent in each phase of parsing, when not enabled nothing is counted or timed
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.reads = 0
+        self.seeks = 0
+        self.bytes = 0
+        self.end = None
+        self.times = {}
+        self.lock = Lock()
+
+    def count(self, offset, length):
+        with self.lock:
+            self.reads += 1
+            self.seeks += offset != self.end
+            self.bytes += length
+            self.end = offset + length
+
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + perf_counter() - start
+
+    def phase(self, name):
+        return self.timer(name) if self.enabled else nullcontext()
+
+    def asdict(self):
+        return {'reads': self.reads, 'seeks': self.seeks, 'bytes': self.bytes, 'times': dict(self.times)}
+
+    def __str__(self):
+        return ', '.join([f'{self.reads} reads', f'{self.seeks} seeks', f'{self.bytes} bytes'] +
+                         [f'{name}: {1000 * t:.1f} ms' for name, t in self.times.items()])
+
+
+class layoutcache():
+    """ Directory with the parsed layouts of tiff files, one npz file of flat arrays per tiff, keyed by its path,
+        size, modification time and a fingerprint of its header and first ifd. The arrays are loaded without
+        unpickling anything. When the total size exceeds maxsize bytes the least recently used layouts are removed.
+    """
+    version = 7  # change when the format of the layout changes
+
+    def __init__(self, path=None, maxsize=2 ** 30):
+        self.path = path or join(os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'), 'tiffexplore')
+        self.maxsize = maxsize
+
+    def get_file(self, tiff):
+        return join(self.path, sha1(abspath(tiff.file).encode()).hexdigest() + '.npz')
+
+    def get_key(self, tiff):
+        stat = os.stat(tiff.file)
+        return repr((self.version, abspath(tiff.file), stat.st_size, stat.st_mtime_ns, tiff.fingerprint()))
+
+    @staticmethod
+    def pack_keys(keys):
+        """ 2d array of tuples of ints of different lengths, padded with -1 """
+        keys = list(keys)
+        lengths = np.array([len(key) for key in keys], 'int64')
+        array = np.full((len(keys), lengths.max(initial=0)), -1, 'int64')
+        for n in np.unique(lengths).tolist():
+            rows = np.flatnonzero(lengths == n)
+            array[rows, :n] = np.array([keys[i] for i in rows.tolist()], 'int64').reshape((-1, n))
+        return array
+
+    @staticmethod
+    def unpack_keys(array):
+        lengths = (array >= 0).sum(1)
+        keys = [()] * len(array)
+        for n in np.unique(lengths).tolist():
+            rows = np.flatnonzero(lengths == n).tolist()
+            for i, key in zip(rows, map(tuple, array[rows, :n].tolist())):
+                keys[i] = key
+        return keys
+
+    def load(self, tiff):
+        """ Returns the cached layout of tiff, or None if it is not cached or the file changed """
+        file = self.get_file(tiff)
+        try:
+            with np.load(file, allow_pickle=False) as f:
+                if str(f['key']) != self.get_key(tiff):
+                    os.remove(file)
+                    return None
+                layout = {name: f[name] for name in f.files if name != 'key'}
+            os.utime(file)
+            return layout
+        except FileNotFoundError:
+            return None
+        except Exception:
+            print(format_exc())
+            return None
+
+    def save(self, tiff):
+        file = self.get_file(tiff)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(f'{file}.{os.getpid()}.tmp', 'wb') as f:
+                np.savez(f, key=np.array(self.get_key(tiff)), **tiff.get_layout())
+            os.replace(f'{file}.{os.getpid()}.tmp', file)
+            self.evict()
+        except Exception:
+            print(format_exc())
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file[1] for file in files)
+        for _, filesize, file in sorted(files):
+            if size <= self.maxsize:
+                break
+            os.remove(file)
+            size -= filesize
+
+
+class segmentcache(OrderedDict):
+    """ Least recently used cache of decoded segments, evicting segments when their total size exceeds maxsize bytes
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.lock = Lock()
+        super().__init__()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self:
+                self.move_to_end(key)
+                return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self:
+                self.size -= self.pop(key).nbytes
+            super().__setitem__(key, value)
+            self.size += value.nbytes
+            while self.size > self.maxsize and len(self) > 1:
+                self.size -= self.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+            self.size = 0
+
+
+class tagrecord():
+    """ A tag of an ifd: its type, the address and size in bytes of its value and the value itself """
+    __slots__ = 'ttype', 'address', 'size', 'value'
+
+    def __init__(self, ttype, address, size, value):
+        self.ttype = ttype
+        self.address = address
+        self.size = size
+        self.value = value
+
+    def __iter__(self):
+        return iter((self.ttype, self.address, self.size, self.value))
+
+    def __repr__(self):
+        return f'tagrecord({self.ttype}, {self.address}, {self.size}, {self.value!r})'
+
+
+class tagtable(Mapping):
+    """ The tags of an ifd: its entries as read from the file, in a structured array, a tagrecord with the decoded
+        value is made each time a tag is looked up. Repeated codes are kept in the entries, looking up a code gives
+        its last entry.
+    """
+    __slots__ = 'tiff', 'offset', 'entries'
+
+    def __init__(self, tiff, offset, entries):
+        self.tiff = tiff
+        self.offset = offset
+        self.entries = entries
+
+    @property
+    def codes(self):
+        """ the codes of all entries, in the order of the table """
+        return self.entries['code'].tolist()
+
+    @property
+    def sizes(self):
+        """ the size in bytes of the value of every entry, 0 for unknown types """
+        return [self.tiff.typesizes.get(ttype, 0) * count
+                for ttype, count in zip(self.entries['ttype'].tolist(), self.entries['count'].tolist())]
+
+    def find(self, code):
+        """ the row of the last entry with code """
+        codes = self.codes
+        if code not in codes:
+            raise KeyError(code)
+        return len(codes) - 1 - codes[::-1].index(code)
+
+    def record(self, row):
+        """ tagrecord of the entry in row, the raw bytes of the entry are the value of a tag of unknown type """
+        tiff = self.tiff
+        _, ttype, count, raw = self.entries[row].item()
+        address = self.offset + struct.calcsize(tiff.tagnoformat) + row * tiff.tagsize + 4 + tiff.offsetsize
+        if ttype not in tiff.typesizes:
+            return tagrecord(ttype, address, 0, raw)
+        size = tiff.typesizes[ttype] * count
+        try:
+            if size > tiff.offsetsize:
+                address = struct.unpack(tiff.byteorder + tiff.offsetformat, raw)[0]
+                raw = tiff.read(address, size)
+            value = tiff.decode_tag(ttype, tifffile.TIFF.DATA_FORMATS[ttype], count, raw[:size])
+        except Exception:  # the value is (partly) outside the file
+            value = np.zeros(0, int)
+        return tagrecord(ttype, address, size, value)
+
+    def __getitem__(self, code):
+        return self.record(self.find(code))
+
+    def __contains__(self, code):
+        return code in self.codes
+
+    def __iter__(self):
+        return iter(dict.fromkeys(self.codes))
+
+    def __len__(self):
+        return len(set(self.codes))
+
+
+class ifdchain():
+    """ Stores the ifds read from one chain of sub ifds until they are merged into the tiff """
+    def __init__(self):
+        self.offsets = {}
+        self.nTags = {}
+        self.tags = {}
+        self.seen = set()
+        self.unread = []  # the ifds of the chain, in order
+        self.addresses = {}
+
+    def cut(self, seen):
+        """ Removes the ifds from the first one with an offset in seen onwards, the chain then ends at that offset """
+        n = next((i for i, idx in enumerate(self.unread) if self.offsets[idx] in seen), len(self.unread))
+        cut, self.unread = set(self.unread[n:]), self.unread[:n]
+        for idx in cut:
+            self.seen.discard(self.offsets[idx])
+            self.offsets.pop(idx[:-1] + (idx[-1] + 1,), None)
+            self.nTags.pop(idx)
+            self.tags.pop(idx)
+        if cut:
+            size = len(next(iter(cut)))
+            self.addresses = {key: value for key, value in self.addresses.items() if key[1][:size] not in cut}
 
 
 class assignments(dict):
+    """ dict of key: (offset, length) which also keeps a sorted index of the offsets and ends of its regions, so
+        lookups are O(log n) and a walk over the file is a single pass. Many regions at once, like the strips or
+        tiles of an ifd, are added as arrays with add_array(key, offsets, lengths): region i is then
+        (key[0], (*key[1], i)), which can be looked up like any other region, but is not stored as a key of the dict.
+        The index is built with numpy when it is needed after regions were removed or replaced, regions which were
+        only added since are merged into it.
+    """
     def __init__(self, max_addr=0, *args, **kwargs):
         self.max_addr = max_addr
-        super().__init__(*args, **kwargs)
+        self.arrays = {}  # key: (offsets, lengths) of regions added as arrays
+        self.index = None  # regionindex, None when it needs to be built again
+        self.added = [], []  # keys and arrays added since the index was built
+        self.version = 0  # changes whenever a region is added or removed
+        self.overlaps = None  # (version, result of get_overlaps)
+        super().__init__()
+        self.update(*args, **kwargs)
 
-    def get_assignment(self, addr):
-        keys, values = zip(*self.items())
-        offsets, lengths = zip(*values)
-        offset_arr = np.array(offsets)
-        offset_len = offset_arr + lengths
-        nearest_addr = np.max(offset_arr[offset_arr <= addr])
-        idxs = np.where(offset_arr == nearest_addr)[0]
-        if addr < nearest_addr + lengths[idxs[0]]:
-            return [(keys[idx], self[keys[idx]]) for idx in idxs]
+    @property
+    def starts(self):
+        return self.sort().starts
+
+    @property
+    def ends(self):
+        return self.sort().ends
+
+    def sort(self):
+        if self.index is None:
+            self.index = regionindex(self)
+        elif self.added[0] or self.added[1]:
+            self.index.extend(self, *self.added)
+        self.added = [], []
+        return self.index
+
+    def changed(self, keys=None, arrays=None):
+        """ keys, arrays: the keys of the only regions and arrays which were added, None if any were removed or
+            replaced, in which case the index is built again
+        """
+        if keys is None and arrays is None:
+            self.index = None
+        elif self.index is not None:
+            self.added[0].extend(keys or ())
+            self.added[1].extend(arrays or ())
+        self.version += 1
+
+    def add_array(self, key, offsets, lengths):
+        n = min(len(offsets), len(lengths))
+        offsets, lengths = np.asarray(offsets[:n], 'int64'), np.asarray(lengths[:n], 'int64')
+        if key in self.arrays:
+            if all(np.array_equal(a, b) for a, b in zip(self.arrays[key], (offsets, lengths))):
+                return
+            self.arrays[key] = offsets, lengths
+            self.changed()
         else:
-            previous_addr = np.max(offset_len[offset_len <= addr])
-            next_addr = offset_arr[offset_arr > addr]
-            length = np.min(next_addr) - previous_addr if len(next_addr) else self.max_addr - previous_addr
-            return [(('empty',), (previous_addr, length))]
+            self.arrays[key] = offsets, lengths
+            self.changed(arrays=[key])
+
+    def get_array_item(self, key):
+        """ (offset, length) of a region added with add_array, None if there is no such region """
+        try:
+            offsets, lengths = self.arrays[(key[0], key[1][:-1])]
+            if 0 <= key[1][-1] < len(offsets):
+                return int(offsets[key[1][-1]]), int(lengths[key[1][-1]])
+        except (KeyError, IndexError, TypeError):
+            pass
+
+    def __missing__(self, key):
+        value = self.get_array_item(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return super().__contains__(key) or self.get_array_item(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        old = dict.get(self, key)
+        super().__setitem__(key, value)
+        if old is None:
+            self.changed([key])
+        elif old != value:
+            self.changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed()
+
+    def update(self, *args, **kwargs):
+        if self.index is None:  # there is no index to merge the regions into
+            super().update(*args, **kwargs)
+            self.changed()
+            return
+        items = dict(*args, **kwargs)
+        added = not any(dict.__contains__(self, key) for key in items)
+        super().update(items)
+        self.changed(list(items) if added else None)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        value = super().pop(key, *args)
+        self.changed()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self.changed()
+        return item
+
+    def clear(self):
+        super().clear()
+        self.arrays.clear()
+        self.changed()
+
+    def copy(self):
+        new = assignments(self.max_addr, self)
+        new.arrays.update(self.arrays)
+        return new
+
+    def _region(self, idx, addr):
+        """ the regions starting at self.starts[idx] if addr is inside the first of them """
+        if idx >= 0:
+            items = self.sort().get_items(idx)
+            if addr < sum(items[0][1]):
+                return items
+
+    def _empty(self, idx, jdx):
+        """ the gap between the last end self.ends[jdx - 1] and the next offset self.starts[idx + 1] """
+        previous_addr = int(self.ends[jdx - 1]) if jdx > 0 else 0
+        next_addr = int(self.starts[idx + 1]) if idx + 1 < len(self.starts) else self.max_addr
+        return [(('empty',), (previous_addr, next_addr - previous_addr))]
+
+    def get_assignment(self, addr):
+        idx = int(np.searchsorted(self.starts, addr, 'right')) - 1
+        return self._region(idx, addr) or self._empty(idx, int(np.searchsorted(self.ends, addr, 'right')))
 
     def get_assignments(self, start=0, end=-1):
-        addr = start
         if end == -1:
             end = self.max_addr
+        addr, version = start, None
         while addr < end:
-            item = self.get_assignment(addr)
+            if version != self.version:  # regions were added or removed while walking
+                index, version = self.sort(), self.version
+                n, ends = len(index.starts), index.ends
+                idx = int(np.searchsorted(index.starts, addr, 'right')) - 1
+                jdx = int(np.searchsorted(ends, addr, 'right'))
+                block, starts, items = index.get_block(max(idx, 0))
+            while idx + 1 < n:
+                if not 0 <= idx + 1 - block < len(starts):
+                    block, starts, items = index.get_block(idx + 1)
+                if starts[idx + 1 - block] > addr:
+                    break
+                idx += 1
+            item = None
+            if idx >= 0:
+                if not 0 <= idx - block < len(items):
+                    block, starts, items = index.get_block(idx)
+                if addr < sum(items[idx - block][0][1]):
+                    item = items[idx - block]
+            if item is None:
+                while jdx < len(ends) and ends[jdx] <= addr:
+                    jdx += 1
+                item = self._empty(idx, jdx)
             addr = sum(item[0][1])
             yield item
+
+    def get_overlaps(self):
+        """ Finds overlapping regions with a sweep line over the distinct regions sorted by offset, returns a dict:
+                identical: lists of keys of regions with the same offset and length
+                overlaps: (keys, other keys, offset, length, kind) for every pair of overlapping distinct regions,
+                    keys are the keys of all regions identical to the region, offset and length are those of the
+                    overlap and kind is 'contained' or 'partial'
+                out_of_bounds: keys of regions extending beyond max_addr
+            only clusters of regions not separated by the end of all regions before them are swept, the result is
+            kept until regions are added or removed
+        """
+        if self.overlaps is not None and self.overlaps[0] == self.version:
+            return self.overlaps[1]
+        index = self.sort()
+        order = np.lexsort((index.lengths, index.offsets))
+        offsets, lengths = index.offsets[order], index.lengths[order]
+        distinct = np.r_[True, (offsets[1:] != offsets[:-1]) | (lengths[1:] != lengths[:-1])][:len(order)]
+        firsts = np.flatnonzero(distinct)
+        lasts = np.r_[firsts[1:], len(order)]
+        regions = {}  # index of distinct region: keys of the regions identical to it
+
+        def get_keys(i):
+            if i not in regions:
+                regions[i] = [index.get_key(row) for row in order[firsts[i]:lasts[i]]]
+            return regions[i]
+
+        identical = [get_keys(i) for i in np.flatnonzero(lasts - firsts > 1).tolist()]
+        overlaps = []
+        nonzero = np.flatnonzero(lengths[firsts] > 0)  # distinct regions which can overlap
+        starts, ends = offsets[firsts[nonzero]], (offsets + lengths)[firsts[nonzero]]
+        if len(nonzero) > 1:
+            reach = np.maximum.accumulate(ends)[:-1]
+            clusters = np.flatnonzero(np.r_[True, starts[1:] >= reach, True])
+            for a, b in zip(clusters[:-1].tolist(), clusters[1:].tolist()):
+                if b - a < 2:
+                    continue
+                active = []  # heap of (end, index) of the regions the sweep line is in
+                for i, offset, end in zip(nonzero[a:b].tolist(), starts[a:b].tolist(), ends[a:b].tolist()):
+                    while active and active[0][0] <= offset:
+                        heappop(active)
+                    for other_end, j in active:
+                        kind = 'contained' if end <= other_end or int(offsets[firsts[j]]) == offset else 'partial'
+                        overlaps.append((get_keys(j), get_keys(i), offset, min(end, other_end) - offset, kind))
+                    heappush(active, (end, i))
+        out = np.flatnonzero(index.offsets + index.lengths > self.max_addr).tolist()
+        result = {'identical': identical, 'overlaps': overlaps, 'out_of_bounds': [index.get_key(row) for row in out]}
+        self.overlaps = self.version, result
+        return result
+
+
+class regionindex():
+    """ The regions of an assignments sorted by offset, in numpy arrays:
+            offsets, lengths: of every region, sorted by offset, regions with the same offset in order of insertion,
+                but those added as arrays after the others
+            group, item: the key of a region is keys[item] if group is -1, else item of arrays group
+            starts: the distinct offsets, first: the first region at each of them, and the number of regions
+            ends: the sorted ends of all regions
+        walks over the regions convert them to python objects a block of blocksize starts at a time, the starts
+        of a block include the first start of the next block
+    """
+    blocksize = 2 ** 10
+
+    def __init__(self, regions):
+        self.keys = list(dict.keys(regions))
+        self.groups = list(regions.arrays)
+        self.offsets, self.lengths, self.group, self.item = \
+            self.get_rows(list(dict.values(regions)), [regions.arrays[key] for key in self.groups])
+        self.ends = np.sort(self.offsets + self.lengths)
+        self.set_starts()
+
+    @staticmethod
+    def get_rows(values, arrays, nkeys=0, ngroups=0):
+        """ offsets, lengths, group and item of regions values and arrays, sorted by offset, numbered from nkeys and
+            ngroups
+        """
+        values = np.array(values, 'int64').reshape((-1, 2))
+        offsets = np.concatenate([values[:, 0]] + [a[0] for a in arrays])
+        lengths = np.concatenate([values[:, 1]] + [a[1] for a in arrays])
+        group = np.concatenate([np.full(len(values), -1, 'int32')] +
+                               [np.full(len(a[0]), ngroups + i, 'int32') for i, a in enumerate(arrays)])
+        item = np.concatenate([np.arange(nkeys, nkeys + len(values))] + [np.arange(len(a[0])) for a in arrays])
+        order = np.argsort(offsets, kind='stable')
+        return offsets[order], lengths[order], group[order], item[order]
+
+    def set_starts(self):
+        distinct = np.flatnonzero(np.r_[True, self.offsets[1:] != self.offsets[:-1]][:len(self.offsets)])
+        self.starts, self.first = self.offsets[distinct], np.r_[distinct, len(self.offsets)]
+        self.block = None  # (first start, starts, items) of the last block used
+
+    def extend(self, regions, keys, groups):
+        """ Merges the regions with keys and the arrays groups, which were added to regions, into the index in
+            O(n + m log m) for m new regions: when regions are appended to a growing file they only need to be sorted
+        """
+        rows = self.get_rows([dict.__getitem__(regions, key) for key in keys], [regions.arrays[key] for key in groups],
+                             len(self.keys), len(self.groups))
+        self.keys.extend(keys)
+        self.groups.extend(groups)
+        # in the order of a new index: at the same offset regions which are keys before those of arrays, each in
+        # the order in which they were added
+        at = np.searchsorted(self.offsets, rows[0], 'right')
+        keys = rows[2] < 0
+        if keys.any():
+            left = np.searchsorted(self.offsets, rows[0][keys], 'left')
+            nkeys = np.r_[0, np.cumsum(self.group < 0)]
+            at[keys] = left + nkeys[at[keys]] - nkeys[left]
+        self.offsets, self.lengths, self.group, self.item = \
+            [np.insert(old, at, new) for old, new in zip((self.offsets, self.lengths, self.group, self.item), rows)]
+        ends = np.sort(rows[0] + rows[1])
+        self.ends = np.insert(self.ends, np.searchsorted(self.ends, ends), ends)
+        self.set_starts()
+        return self
+
+    def get_block(self, idx):
+        start = idx - idx % self.blocksize
+        block = self.block
+        if block is None or block[0] != start:
+            first = self.first[start:start + self.blocksize + 1].tolist()
+            rows = slice(first[0], first[-1])
+            keys = [self.keys[item] if group < 0 else (self.groups[group][0], (*self.groups[group][1], item))
+                    for group, item in zip(self.group[rows].tolist(), self.item[rows].tolist())]
+            items = list(zip(keys, zip(self.offsets[rows].tolist(), self.lengths[rows].tolist())))
+            items = [items[a - first[0]:b - first[0]] for a, b in zip(first[:-1], first[1:])]
+            block = self.block = start, self.starts[start:start + self.blocksize + 1].tolist(), items
+        return block
+
+    def get_items(self, idx):
+        """ [(key, (offset, length))] of the regions starting at starts[idx] """
+        start, _, items = self.get_block(idx)
+        return items[idx - start]
+
+    def get_key(self, row):
+        group, item = self.group[row], int(self.item[row])
+        if group < 0:
+            return self.keys[item]
+        code, idx = self.groups[group]
+        return code, (*idx, item)